@@ -1,26 +1,62 @@
 import os
 import json
+import numpy as np
 import networkx as nx
 import plotly.graph_objects as go
 import tkinter as tk
 from tkinter import ttk, messagebox
 import threading
+import queue
 from colorsys import hls_to_rgb
 import tempfile
+from collections import Counter
 import webbrowser
 import platform
 from PIL import Image, ImageTk
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+from graph_layout import LayoutCache, barnes_hut_layout, cached_layout, get_layout_engine
+from graph_store import GraphStore, binary_path, open_store
+from temporal_network import load_timeline, timeline_snapshots
+from communities import CommunityCache, cached_communities, collapse, community_label, community_summary
 
 
 class HPNetworkVisualizer:
+    SIDE_COLORS = {
+        "Положительный": "#4CAF50",
+        "Отрицательный": "#F44336",
+        "Нейтральный": "#607D8B",
+        "Неопределённый": "#9C27B0",
+        "unknown": "#4682B4"
+    }
+
     def __init__(self, root):
         self.root = root
         self.temp_html_file = None
-        self.setup_ui()
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.layout_cache = LayoutCache(os.path.join(base_dir, "data", "layout_cache"))
+        self.community_cache = CommunityCache(os.path.join(base_dir, "data", "community_cache"))
+        # Раскладки супер-узлов и раскрытых сообществ - отдельно от раскладок полного графа.
+        self.community_layout_cache = LayoutCache(os.path.join(base_dir, "data", "community_cache", "layouts"))
+        self.community_method = 'louvain'
+        self.membership = None
+        self.membership_graph = None
+        self.layout_engine = 'auto'
+        self.html_mode = 'shared'
+        self.html_dir = os.path.join(tempfile.gettempdir(), "hp_network_visualization")
+        self.graph = None
+        self.graph_pos = None
+        self.layout_graph = None
+        self.character_data = None
+        self.loaded_mtimes = None
+        self.events = queue.Queue()
+        # root=None - режим без окна (пакетная отрисовка): только загрузка и построение фигур.
+        if self.root is not None:
+            self.setup_ui()
+            self.root.after(100, self.poll_events)
 
     def setup_ui(self):
         self.root.title("Анализатор социальной сети Гарри Поттера")
-        self.root.geometry("900x700")
+        self.root.geometry("900x1000")
         self.root.resizable(True, True)
         self.root.configure(bg='#f0f8ff')
 
@@ -82,6 +118,68 @@ class HPNetworkVisualizer:
         )
         self.load_btn.pack(pady=10, ipadx=20, ipady=10)
 
+        self.animation_btn = ttk.Button(
+            btn_frame,
+            text="Анимация по главам",
+            command=self.animate_chapters,
+            style='TButton'
+        )
+        self.animation_btn.pack(pady=(0, 10), ipadx=20)
+
+        lod_frame = tk.LabelFrame(
+            content_frame,
+            text="Уровень детализации",
+            font=('Arial', 11, 'bold'),
+            bg='#f0f8ff'
+        )
+        lod_frame.pack(pady=10, ipadx=10, ipady=5)
+
+        self.min_weight_var = tk.DoubleVar(value=0.0)
+        self.top_k_var = tk.IntVar(value=0)
+        self.label_degree_var = tk.IntVar(value=0)
+        self.webgl_threshold_var = tk.IntVar(value=2000)
+        lod_fields = [
+            ("Мин. сила связи:", self.min_weight_var, 0, 10000, 0.5),
+            ("Сильнейших связей на узел (0 - все):", self.top_k_var, 0, 1000, 1),
+            ("Подписи при числе связей от:", self.label_degree_var, 0, 10000, 1),
+            ("WebGL при числе элементов от:", self.webgl_threshold_var, 0, 1000000, 500),
+        ]
+        for row, (label, var, low, high, step) in enumerate(lod_fields):
+            tk.Label(lod_frame, text=label, bg='#f0f8ff', font=('Arial', 10)).grid(
+                row=row, column=0, sticky='w', padx=5, pady=2)
+            tk.Spinbox(lod_frame, textvariable=var, from_=low, to=high, increment=step,
+                       width=10).grid(row=row, column=1, padx=5, pady=2)
+
+        self.apply_btn = ttk.Button(
+            lod_frame,
+            text="Применить",
+            command=self.apply_lod,
+            style='TButton'
+        )
+        self.apply_btn.grid(row=len(lod_fields), column=0, columnspan=2, pady=(5, 0))
+
+        community_frame = tk.LabelFrame(
+            content_frame,
+            text="Сообщества",
+            font=('Arial', 11, 'bold'),
+            bg='#f0f8ff'
+        )
+        community_frame.pack(pady=10, ipadx=10, ipady=5, fill='x')
+
+        self.communities_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            community_frame,
+            text="Свернуть сообщества в супер-узлы",
+            variable=self.communities_var,
+            bg='#f0f8ff',
+            font=('Arial', 10)
+        ).pack(anchor='w', padx=5)
+        tk.Label(community_frame, text="Раскрыть (выделите и нажмите «Применить»):",
+                 bg='#f0f8ff', font=('Arial', 10)).pack(anchor='w', padx=5)
+        self.community_list = tk.Listbox(community_frame, selectmode='multiple', height=5,
+                                         exportselection=False, font=('Arial', 10))
+        self.community_list.pack(fill='x', padx=5, pady=(0, 5))
+
         legend_frame = tk.Frame(content_frame, bg='#e3f2fd', bd=2, relief='groove')
         legend_frame.pack(pady=20, ipadx=10, ipady=10)
 
@@ -120,15 +218,22 @@ class HPNetworkVisualizer:
         status_bar.pack(side='bottom', fill='x')
 
     def load_json(self, file_path):
+        # Свежая бинарная копия рядом с JSON открывается через memmap без разбора JSON;
+        # сеть возвращается как GraphStore, атрибуты - словарём.
+        store = open_store(file_path)
+        if store is not None:
+            return store if store.has_network else store.to_attributes()
         try:
             with open(file_path, "r", encoding="utf-8") as file:
                 return json.load(file)
         except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить файл {file_path}: {str(e)}")
-            return None
+            raise RuntimeError(f"Не удалось загрузить файл {file_path}: {str(e)}") from e
 
     def create_graph(self, data):
         G = nx.Graph()
+        if isinstance(data, GraphStore):
+            G.add_weighted_edges_from(data.edges())
+            return G
         for char, relations in data.items():
             for other_char, weight in relations.items():
                 G.add_edge(char, other_char, weight=weight)
@@ -141,20 +246,245 @@ class HPNetworkVisualizer:
         r, g, b = hls_to_rgb(hue, lightness, saturation)
         return f"#{int(r * 255):02x}{int(g * 255):02x}{int(b * 255):02x}"
 
-    def interactive(self, G, character_info):
-        pos = nx.spring_layout(G, k=0.5, iterations=50, seed=42)
+    def blue_gradient_array(self, intensities):
+        # Векторный вариант blue_gradient: тот же перевод HLS -> RGB из colorsys,
+        # но сразу для всего массива интенсивностей.
+        hue = 240 / 360
+        saturation = 0.9
+        lightness = 0.85 - (0.7 * np.asarray(intensities, dtype=float))
+        m2 = np.where(lightness <= 0.5,
+                      lightness * (1.0 + saturation),
+                      lightness + saturation - lightness * saturation)
+        m1 = 2.0 * lightness - m2
+
+        def channel(h):
+            h = h % 1.0
+            if h < 1 / 6:
+                return m1 + (m2 - m1) * h * 6.0
+            if h < 0.5:
+                return m2
+            if h < 2 / 3:
+                return m1 + (m2 - m1) * (2 / 3 - h) * 6.0
+            return m1
+
+        rgb = np.stack([channel(hue + 1 / 3), channel(hue), channel(hue - 1 / 3)], axis=-1)
+        rgb = (rgb * 255).astype(int)
+        return [f"#{r:02x}{g:02x}{b:02x}" for r, g, b in rgb]
+
+    def edge_arrays(self, G, pos):
+        edges = list(G.edges())
+        weights = np.array([G.edges[edge]['weight'] for edge in edges], dtype=float)
+        start = np.array([pos[u] for u, _ in edges], dtype=float).reshape(-1, 2)
+        end = np.array([pos[v] for _, v in edges], dtype=float).reshape(-1, 2)
+        return edges, weights, start, end
+
+    def edge_intensities(self, weights):
+        if len(weights) == 0:
+            return np.empty(0)
+        min_weight = weights.min()
+        max_weight = weights.max()
+        weight_range = max_weight - min_weight if max_weight != min_weight else 1
+        return (weights - min_weight) / weight_range
+
+    def lod_settings(self):
+        try:
+            return {
+                'min_weight': float(self.min_weight_var.get()),
+                'top_k': max(0, int(self.top_k_var.get())),
+                'label_degree': max(0, int(self.label_degree_var.get())),
+                'webgl_threshold': max(0, int(self.webgl_threshold_var.get())),
+                'communities': bool(self.communities_var.get()),
+                'expanded': list(self.community_list.curselection()),
+            }
+        except (tk.TclError, ValueError):
+            messagebox.showerror("Ошибка", "Некорректные параметры детализации")
+            return None
 
-        side_colors = {
-            "Положительный": "#4CAF50",
-            "Отрицательный": "#F44336",
-            "Нейтральный": "#607D8B",
-            "Неопределённый": "#9C27B0",
-            "unknown": "#4682B4"
-        }
+    def lod_filter(self, G, min_weight=0.0, top_k=0):
+        # Узлы сохраняются все (их координаты уже посчитаны), отбрасываются только рёбра:
+        # слабее порога и не входящие в top_k сильнейших ни у одного из концов.
+        edges = list(G.edges(data='weight'))
+        if not edges or (min_weight <= 0 and top_k <= 0):
+            return G
+        weights = np.array([w for _, _, w in edges], dtype=float)
+        keep = weights >= min_weight
+        if top_k > 0:
+            index = {node: i for i, node in enumerate(G.nodes())}
+            ends = np.array([(index[u], index[v]) for u, v, _ in edges], dtype=np.int64)
+            edge_ids = np.flatnonzero(keep)
+            owner = np.concatenate([ends[edge_ids, 0], ends[edge_ids, 1]])
+            candidate = np.concatenate([edge_ids, edge_ids])
+            order = np.lexsort((-weights[candidate], owner))
+            owner, candidate = owner[order], candidate[order]
+            first = np.searchsorted(owner, owner)
+            rank = np.arange(len(owner)) - first
+            keep = np.zeros(len(edges), dtype=bool)
+            keep[candidate[rank < top_k]] = True
+
+        H = nx.Graph()
+        H.add_nodes_from(G.nodes(data=True))
+        H.add_weighted_edges_from(edge for edge, kept in zip(edges, keep) if kept)
+        return H
+
+    def single_edge_traces(self, G, pos, scatter=go.Scatter):
+        edge_traces = []
+        edges, weights, _, _ = self.edge_arrays(G, pos)
+        intensities = self.edge_intensities(weights)
+        for edge, weight, intensity in zip(edges, weights, intensities):
+            x0, y0 = pos[edge[0]]
+            x1, y1 = pos[edge[1]]
+            normalized_width = max(1, min(8, 1 + 7 * intensity))
+            color = self.blue_gradient(intensity)
+
+            edge_trace = scatter(
+                x=[x0, x1, None],
+                y=[y0, y1, None],
+                line=dict(width=normalized_width, color=color),
+                hoverinfo='text',
+                hovertext=f"{edge[0]} ↔ {edge[1]}<br>Сила связи: {weight:.1f}",
+                mode='lines',
+                showlegend=False
+            )
+            edge_traces.append(edge_trace)
+        return edge_traces
+
+    def batched_edge_traces(self, G, pos, width_buckets=8, color_buckets=8, scatter=go.Scatter):
+        # Рёбра группируются по квантованной толщине и цвету: число трасс не больше
+        # width_buckets + color_buckets - 1 независимо от размера графа.
+        edges, weights, start, end = self.edge_arrays(G, pos)
+        if not edges:
+            return []
+
+        intensities = self.edge_intensities(weights)
+        width_idx = np.rint(intensities * (width_buckets - 1)).astype(int)
+        color_idx = np.rint(intensities * (color_buckets - 1)).astype(int)
+        widths = 1 + 7 * width_idx / max(width_buckets - 1, 1)
+        colors = self.blue_gradient_array(np.arange(color_buckets) / max(color_buckets - 1, 1))
 
+        edge_traces = []
+        groups = width_idx * color_buckets + color_idx
+        for group in np.unique(groups):
+            mask = groups == group
+            count = int(mask.sum())
+            # Разрывы между отрезками - NaN, а не None: тогда координаты остаются
+            # числовым массивом и попадают в HTML компактным типизированным base64.
+            xs = np.full(3 * count, np.nan, dtype=np.float32)
+            ys = np.full(3 * count, np.nan, dtype=np.float32)
+            xs[0::3] = start[mask, 0]
+            xs[1::3] = end[mask, 0]
+            ys[0::3] = start[mask, 1]
+            ys[1::3] = end[mask, 1]
+            first = np.argmax(mask)
+            edge_traces.append(scatter(
+                x=xs,
+                y=ys,
+                line=dict(width=float(widths[first]), color=colors[color_idx[first]]),
+                hoverinfo='skip',
+                mode='lines',
+                showlegend=False
+            ))
+
+        middle = ((start + end) / 2).astype(np.float32)
+        edge_traces.append(scatter(
+            x=middle[:, 0],
+            y=middle[:, 1],
+            mode='markers',
+            marker=dict(size=8, opacity=0),
+            hoverinfo='text',
+            hovertext=[f"{u} ↔ {v}<br>Сила связи: {w:.1f}"
+                       for (u, v), w in zip(edges, weights)],
+            showlegend=False
+        ))
+        return edge_traces
+
+    def graph_layout(self, G):
+        # Раскладка считается по полному графу один раз; смена детализации её не трогает.
+        if G is not self.layout_graph or self.graph_pos is None:
+            layout_func = get_layout_engine(self.layout_engine, G)
+            self.graph_pos = cached_layout(G, self.layout_cache, layout_func, k=0.5, iterations=50, seed=42)
+            self.layout_graph = G
+        return self.graph_pos
+
+    def interactive(self, G, character_info, edge_mode='batched', lod=None):
+        # Выполняется в фоновом потоке: Tk не трогает, прогресс уходит в очередь событий.
+        lod = lod or {}
+        if lod.get('communities'):
+            return self.interactive_communities(G, character_info, edge_mode, lod)
+        self.post('status', "Расчёт раскладки...")
+        pos = self.graph_layout(G)
+        self.post('status', "Построение визуализации...")
+        fig = self.build_figure(G, pos, character_info, edge_mode, lod)
+        self.post('status', "Запись HTML...")
+        return self.show_figure(fig)
+
+    def graph_communities(self, G):
+        # Разбиение считается один раз на граф и кэшируется на диске по хэшу графа.
+        if G is not self.membership_graph:
+            self.post('status', "Поиск сообществ...")
+            self.membership = cached_communities(G, self.community_cache, self.community_method)
+            self.membership_graph = G
+            sizes = Counter(self.membership.values())
+            self.post('communities', [community_label(c, sizes[c]) for c in sorted(sizes)])
+        return self.membership
+
+    def community_layout(self, G, membership, expanded):
+        # Супер-узлы раскладываются один раз (кэш по графу сообществ). Раскрытое сообщество
+        # раскладывается отдельно и вписывается в круг на месте своего супер-узла, поэтому
+        # раскрытие не сдвигает остальные сообщества и пересчитывает только свою часть.
+        overview = collapse(G, membership)
+        overview_pos = cached_layout(overview, self.community_layout_cache,
+                                     get_layout_engine(self.layout_engine, overview),
+                                     k=0.5, iterations=50, seed=42)
+        sizes = Counter(membership.values())
+        largest = max(sizes.values(), default=1)
+        pos = {}
+        for label, data in overview.nodes(data=True):
+            community = data['community']
+            if community not in expanded:
+                pos[label] = overview_pos[label]
+                continue
+            members = [node for node in G.nodes() if membership[node] == community]
+            part = G.subgraph(members)
+            local = cached_layout(part, self.community_layout_cache, get_layout_engine(self.layout_engine, part),
+                                  k=0.5, iterations=50, seed=42)
+            radius = 0.35 * np.sqrt(sizes[community] / largest)
+            for node in members:
+                pos[node] = overview_pos[label] + radius * np.asarray(local[node])
+        return pos
+
+    def interactive_communities(self, G, character_info, edge_mode, lod):
+        membership = self.graph_communities(G)
+        expanded = set(lod.get('expanded', ()))
+        self.post('status', "Расчёт раскладки сообществ...")
+        view = collapse(G, membership, expanded)
+        pos = self.community_layout(G, membership, expanded)
+        info = dict(character_info, **community_summary(G, membership, character_info))
+        weights = dict(view.nodes(data='members'))
+        self.post('status', "Построение визуализации...")
+        fig = self.build_figure(view, pos, info, edge_mode, lod, node_weights=weights)
+        self.post('status', "Запись HTML...")
+        return self.show_figure(fig)
+
+    def build_figure(self, G, pos, character_info, edge_mode='batched', lod=None,
+                     title='Социальная сеть персонажей "Гарри Поттера"', node_weights=None):
+        lod = lod or {}
+        visible = self.lod_filter(G, lod.get('min_weight', 0.0), lod.get('top_k', 0))
+        scatter = go.Scatter
+        if visible.number_of_nodes() + visible.number_of_edges() >= lod.get('webgl_threshold', float('inf')):
+            scatter = go.Scattergl
+
+        side_colors = self.SIDE_COLORS
         degrees = dict(G.degree())
-        max_degree = max(degrees.values()) if degrees else 1
-        node_sizes = [15 + 25 * (degrees[node] / max_degree) for node in G.nodes()]
+        max_degree = max(max(degrees.values(), default=0), 1)
+        if node_weights:
+            # Размер супер-узла растёт как корень из числа персонажей в нём.
+            max_weight = max(node_weights.values())
+            node_sizes = np.array([15 + 45 * np.sqrt(node_weights.get(node, 1) / max_weight)
+                                   for node in G.nodes()], dtype=np.float32)
+        else:
+            node_sizes = np.array([15 + 25 * (degrees[node] / max_degree) for node in G.nodes()],
+                                  dtype=np.float32)
+        node_xy = np.array([pos[node] for node in G.nodes()], dtype=np.float32).reshape(-1, 2)
 
         node_colors = []
         hover_texts = []
@@ -173,40 +503,25 @@ class HPNetworkVisualizer:
                 f"Лояльность: {info.get('loyalty', 'не указана')}<br>"
                 f"Связей: {degrees[node]}"
             )
+            if 'members' in info:
+                text += f"<br>Состав: {info['members']}"
             hover_texts.append(text)
 
-        edge_traces = []
-        weights = [G.edges[edge]['weight'] for edge in G.edges()]
-        if weights:
-            min_weight = min(weights)
-            max_weight = max(weights)
-            weight_range = max_weight - min_weight if max_weight != min_weight else 1
-            for edge in G.edges():
-                x0, y0 = pos[edge[0]]
-                x1, y1 = pos[edge[1]]
-                weight = G.edges[edge]['weight']
-                normalized_width = max(1, min(8, 1 + 7 * (weight - min_weight) / weight_range))
-                intensity = (weight - min_weight) / weight_range
-                color = self.blue_gradient(intensity)
-
-                edge_trace = go.Scatter(
-                    x=[x0, x1, None],
-                    y=[y0, y1, None],
-                    line=dict(width=normalized_width, color=color),
-                    hoverinfo='text',
-                    hovertext=f"{edge[0]} ↔ {edge[1]}<br>Сила связи: {weight:.1f}",
-                    mode='lines',
-                    showlegend=False
-                )
-                edge_traces.append(edge_trace)
+        label_degree = lod.get('label_degree', 0)
+        labels = [node if degrees[node] >= label_degree else '' for node in G.nodes()]
 
-        fig = go.Figure(
+        if edge_mode == 'batched':
+            edge_traces = self.batched_edge_traces(visible, pos, scatter=scatter)
+        else:
+            edge_traces = self.single_edge_traces(visible, pos, scatter=scatter)
+
+        return go.Figure(
             data=edge_traces + [
-                go.Scatter(
-                    x=[pos[node][0] for node in G.nodes()],
-                    y=[pos[node][1] for node in G.nodes()],
-                    mode='markers+text',
-                    text=list(G.nodes()),
+                scatter(
+                    x=node_xy[:, 0],
+                    y=node_xy[:, 1],
+                    mode='markers+text' if any(labels) else 'markers',
+                    text=labels,
                     textposition='top center',
                     hovertext=hover_texts,
                     hoverinfo='text',
@@ -221,7 +536,7 @@ class HPNetworkVisualizer:
             ],
             layout=go.Layout(
                 title=dict(
-                    text='Социальная сеть персонажей "Гарри Поттера"',
+                    text=title,
                     font=dict(size=24, family="Arial", color='black'),
                     x=0.5,
                     xanchor='center'
@@ -240,67 +555,285 @@ class HPNetworkVisualizer:
             )
         )
 
-        try:
-            temp_dir = tempfile.gettempdir()
-            self.temp_html_file = os.path.join(temp_dir, "hp_network_visualization.html")
-
-            if os.path.exists(self.temp_html_file):
-                os.remove(self.temp_html_file)
-
-            fig.write_html(self.temp_html_file, auto_open=False)
+    def plotly_asset(self, directory):
+        # plotly.js (несколько МБ) пишется в каталог один раз на версию библиотеки;
+        # страницы ссылаются на него относительным путём, CDN не нужен.
+        name = f"plotly-{get_plotlyjs_version()}.min.js"
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(get_plotlyjs())
+            os.replace(tmp_path, path)
+        return name
+
+    def write_figure(self, fig, html_file, mode='shared'):
+        if mode == 'shared':
+            asset = self.plotly_asset(os.path.dirname(html_file))
+            fig.write_html(html_file, include_plotlyjs=asset, auto_open=False)
+        else:
+            fig.write_html(html_file, auto_open=False)
+
+    def timeline_graphs(self, timeline, mode=None, window=None):
+        names = timeline['names']
+        for chapter, rows, cols, weights in timeline_snapshots(timeline, mode, window):
+            G = nx.Graph()
+            G.add_weighted_edges_from(
+                (names[i], names[j], w) for i, j, w in zip(rows.tolist(), cols.tolist(), weights.tolist()))
+            yield chapter, G
+
+    def animation_layouts(self, graphs, iterations=50, warm_temperature=0.01):
+        # Каждый кадр стартует с координат предыдущего с малым начальным шагом: при почти
+        # неизменном составе узлов хватает нескольких итераций, и узлы не перескакивают.
+        pos = {}
+        for chapter, G in graphs:
+            if G.number_of_nodes():
+                warm_start = {node: pos[node] for node in G.nodes() if node in pos}
+                steps, temperature = iterations, 0.1
+                if len(warm_start) >= 0.9 * G.number_of_nodes():
+                    steps, temperature = max(5, iterations // 5), warm_temperature
+                pos = dict(pos, **barnes_hut_layout(G, k=0.5, iterations=steps, seed=42,
+                                                    pos=warm_start or None, temperature=temperature))
+            yield chapter, G, pos
+
+    def frame_traces(self, G, pos, nodes, character_info, max_weight, buckets=4):
+        # Число трасс в каждом кадре одинаковое (buckets линий + узлы), а узлы идут в одном
+        # порядке во всех кадрах - так Plotly плавно интерполирует переходы.
+        colors = self.blue_gradient_array(np.arange(buckets) / max(buckets - 1, 1))
+        traces = []
+        edges = list(G.edges(data='weight'))
+        levels = np.array([min(buckets - 1, int(buckets * w / max_weight)) for _, _, w in edges], dtype=int)
+        for level in range(buckets):
+            selected = [edge for edge, edge_level in zip(edges, levels) if edge_level == level]
+            xs = np.full(3 * len(selected), np.nan, dtype=np.float32)
+            ys = np.full(3 * len(selected), np.nan, dtype=np.float32)
+            for k, (u, v, _) in enumerate(selected):
+                xs[3 * k], ys[3 * k] = pos[u]
+                xs[3 * k + 1], ys[3 * k + 1] = pos[v]
+            traces.append(go.Scatter(
+                x=xs, y=ys, mode='lines', hoverinfo='skip', showlegend=False,
+                line=dict(width=1 + 7 * level / max(buckets - 1, 1), color=colors[level])
+            ))
 
-            if platform.system() == 'Windows':
-                os.startfile(self.temp_html_file)
-            elif platform.system() == 'Darwin':
-                webbrowser.open('file://' + os.path.abspath(self.temp_html_file))
-            else:
-                webbrowser.open('file://' + os.path.abspath(self.temp_html_file))
+        degrees = dict(G.degree())
+        max_degree = max(max(degrees.values(), default=0), 1)
+        xy = np.array([pos.get(node, (0.0, 0.0)) for node in nodes], dtype=np.float32).reshape(-1, 2)
+        sizes = np.array([15 + 25 * degrees[node] / max_degree if node in degrees else 0 for node in nodes],
+                         dtype=np.float32)
+        colors = [self.SIDE_COLORS.get(character_info.get(node, {}).get("side", "unknown"), "#4682B4")
+                  for node in nodes]
+        hover = [
+            f"<b>{node}</b><br>"
+            f"Роль: {character_info.get(node, {}).get('role', 'Неизвестно')}<br>"
+            f"Сторона: {character_info.get(node, {}).get('side', 'unknown')}<br>"
+            f"Связей: {degrees.get(node, 0)}"
+            for node in nodes
+        ]
+        traces.append(go.Scatter(
+            x=xy[:, 0], y=xy[:, 1], mode='markers+text',
+            text=[node if node in degrees else '' for node in nodes],
+            textposition='top center', hovertext=hover, hoverinfo='text',
+            marker=dict(color=colors, size=sizes, line=dict(width=2, color='#1A237E')),
+            textfont=dict(size=12, color='black', family="Arial"), showlegend=False
+        ))
+        return traces
+
+    def build_animation(self, timeline, character_info, mode=None, window=None):
+        snapshots = list(self.animation_layouts(self.timeline_graphs(timeline, mode, window)))
+        if not snapshots:
+            raise ValueError("В файле нет ни одной главы")
+        nodes = sorted({node for _, G, _ in snapshots for node in G.nodes()})
+        max_weight = max([w for _, G, _ in snapshots for _, _, w in G.edges(data='weight')], default=1.0)
+
+        frames = []
+        for index, (chapter, G, pos) in enumerate(snapshots):
+            name = f"{index + 1}. {chapter['book']}: {chapter['title']}"
+            frames.append(go.Frame(name=name,
+                                   data=self.frame_traces(G, pos, nodes, character_info, max_weight)))
+
+        step_args = dict(mode='immediate', frame=dict(duration=600, redraw=True), transition=dict(duration=300))
+        return go.Figure(
+            data=frames[0].data,
+            frames=frames,
+            layout=go.Layout(
+                title=dict(
+                    text='Развитие социальной сети персонажей "Гарри Поттера" по главам',
+                    font=dict(size=24, family="Arial", color='black'),
+                    x=0.5,
+                    xanchor='center'
+                ),
+                showlegend=False,
+                hovermode='closest',
+                margin=dict(b=20, l=20, r=20, t=80),
+                xaxis=dict(showgrid=False, zeroline=False, showticklabels=False, range=[-1.2, 1.2]),
+                yaxis=dict(showgrid=False, zeroline=False, showticklabels=False, range=[-1.2, 1.2]),
+                paper_bgcolor='white',
+                plot_bgcolor='white',
+                width=1400,
+                height=900,
+                updatemenus=[dict(
+                    type='buttons',
+                    direction='left',
+                    x=0.05, y=0, xanchor='left', yanchor='top',
+                    buttons=[
+                        dict(label="▶", method='animate', args=[None, dict(step_args, fromcurrent=True)]),
+                        dict(label="⏸", method='animate',
+                             args=[[None], dict(mode='immediate', frame=dict(duration=0, redraw=False))]),
+                    ]
+                )],
+                sliders=[dict(
+                    x=0.15, len=0.85, y=0, yanchor='top',
+                    currentvalue=dict(prefix="Глава: "),
+                    steps=[dict(label=str(index + 1), method='animate', args=[[frame.name], step_args])
+                           for index, frame in enumerate(frames)]
+                )]
+            )
+        )
 
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось создать визуализацию: {str(e)}")
-            self.status_var.set("Ошибка при создании визуализации")
+    def animation_pipeline(self, timeline_path):
+        _, character_data = self.load_data()
+        self.post('status', "Загрузка сетей по главам...")
+        timeline = load_timeline(timeline_path)
+        self.post('status', f"Раскладка {len(timeline['chapters'])} кадров...")
+        fig = self.build_animation(timeline, character_data)
+        self.post('status', "Запись HTML...")
+        return self.show_figure(fig, "hp_network_chapters.html")
+
+    def animate_chapters(self):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        timeline_path = os.path.join(base_dir, "data", "precise_character_network_chapters.json")
+        if not os.path.exists(timeline_path):
+            messagebox.showerror("Ошибка", f"Файл не найден: {timeline_path}\n"
+                                           f"Постройте его командой get_relations.py --chapters cumulative")
+            return
+        self.run_in_background(self.animation_pipeline, timeline_path)
+
+    def show_figure(self, fig, file_name="hp_network_visualization.html"):
+        if self.html_mode == 'shared':
+            self.temp_html_file = os.path.join(self.html_dir, file_name)
+        else:
+            self.temp_html_file = os.path.join(tempfile.gettempdir(), file_name)
+
+        if os.path.exists(self.temp_html_file):
+            os.remove(self.temp_html_file)
+
+        self.write_figure(fig, self.temp_html_file, self.html_mode)
+        html_size = os.path.getsize(self.temp_html_file)
+        print(f"Трасс: {len(fig.data)}, размер HTML: {html_size / 1024:.0f} КБ")
+
+        if platform.system() == 'Windows':
+            os.startfile(self.temp_html_file)
+        elif platform.system() == 'Darwin':
+            webbrowser.open('file://' + os.path.abspath(self.temp_html_file))
+        else:
+            webbrowser.open('file://' + os.path.abspath(self.temp_html_file))
+
+        return (
+            f"Визуализация запущена в браузере (трасс: {len(fig.data)}, "
+            f"HTML: {html_size / 1024:.0f} КБ)"
+        )
 
-    def load_and_visualize(self):
-        self.status_var.set("Загрузка данных...")
-        self.load_btn.config(state='disabled')
-        self.root.update()
+    def post(self, kind, message):
+        self.events.put((kind, message))
 
+    def poll_events(self):
+        # Единственное место, где результаты фоновой работы попадают в виджеты.
         try:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            network_path = os.path.join(base_dir, "data", "precise_character_network.json")
-            character_path = os.path.join(base_dir, "data", "character_info_with_roles.json")
-
-            if not os.path.exists(network_path):
-                messagebox.showerror("Ошибка", f"Файл не найден: {network_path}")
-                self.status_var.set("Файл данных не найден")
-                return
-            if not os.path.exists(character_path):
-                messagebox.showerror("Ошибка", f"Файл не найден: {character_path}")
-                self.status_var.set("Файл данных не найден")
-                return
-
-            network_data = self.load_json(network_path)
-            character_data = self.load_json(character_path)
-
-            if network_data is None or character_data is None:
-                self.status_var.set("Ошибка загрузки данных")
-                return
-
-            G = self.create_graph(network_data)
-
-            threading.Thread(
-                target=self.interactive,
-                args=(G, character_data),
-                daemon=True
-            ).start()
+            while True:
+                kind, message = self.events.get_nowait()
+                if kind == 'status':
+                    self.status_var.set(message)
+                elif kind == 'communities':
+                    self.community_list.delete(0, 'end')
+                    for label in message:
+                        self.community_list.insert('end', label)
+                elif kind == 'error':
+                    self.status_var.set("Ошибка при обработке данных")
+                    messagebox.showerror("Ошибка", message)
+                elif kind == 'done':
+                    self.set_busy(False)
+                    if message:
+                        self.status_var.set(message)
+        except queue.Empty:
+            pass
+        self.root.after(100, self.poll_events)
+
+    def set_busy(self, busy):
+        state = 'disabled' if busy else 'normal'
+        self.load_btn.config(state=state)
+        self.apply_btn.config(state=state)
+        self.animation_btn.config(state=state)
+
+    def run_in_background(self, task, *args):
+        self.set_busy(True)
+
+        def worker():
+            result = None
+            try:
+                result = task(*args)
+            except Exception as e:
+                self.post('error', f"Произошла ошибка: {str(e)}")
+            finally:
+                self.post('done', result)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def data_paths(self):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        return (
+            os.path.join(base_dir, "data", "precise_character_network.json"),
+            os.path.join(base_dir, "data", "character_info_with_roles.json"),
+        )
 
-            self.status_var.set("Визуализация запущена в браузере")
+    def data_mtimes(self, paths):
+        # Учитываются и бинарные копии: load_json может читать их вместо JSON.
+        mtimes = []
+        for path in paths:
+            for candidate in (path, binary_path(path)):
+                mtimes.append(os.path.getmtime(candidate) if os.path.exists(candidate) else None)
+        return tuple(mtimes)
+
+    def load_data(self):
+        paths = self.data_paths()
+        for path in paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Файл не найден: {path}")
+
+        mtimes = self.data_mtimes(paths)
+        if self.graph is not None and mtimes == self.loaded_mtimes:
+            self.post('status', "Данные не изменились, используется граф из памяти")
+            return self.graph, self.character_data
+
+        network_path, character_path = paths
+        self.post('status', "Загрузка данных...")
+        network_data = self.load_json(network_path)
+        character_data = self.load_json(character_path)
+
+        self.post('status', "Построение графа...")
+        G = self.create_graph(network_data)
+        self.graph, self.character_data, self.loaded_mtimes = G, character_data, mtimes
+        return G, character_data
+
+    def pipeline(self, lod):
+        G, character_data = self.load_data()
+        return self.interactive(G, character_data, lod=lod)
+
+    def apply_lod(self):
+        if self.graph is None:
+            self.status_var.set("Сначала загрузите данные")
+            return
+        lod = self.lod_settings()
+        if lod is None:
+            return
+        self.status_var.set("Перестроение отображения...")
+        self.run_in_background(self.interactive, self.graph, self.character_data, 'batched', lod)
 
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Произошла ошибка: {str(e)}")
-            self.status_var.set("Ошибка при обработке данных")
-        finally:
-            self.load_btn.config(state='normal')
+    def load_and_visualize(self):
+        lod = self.lod_settings()
+        if lod is None:
+            return
+        self.run_in_background(self.pipeline, lod)
 
 
 def main():
@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import time
+import argparse
+import multiprocessing
+import networkx as nx
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from app_graph import HPNetworkVisualizer
+from graph_layout import cached_layout, get_layout_engine
+
+# Спецификация вида - словарь:
+#   name                 - имя выходного файла (без .html);
+#   faculty/side/role/blood_status/species/loyalty - фильтр по атрибуту (строка или список;
+#                          значение атрибута должно начинаться с одной из строк);
+#   ego, radius          - эго-сеть персонажа заданного радиуса (по умолчанию 1);
+#   network              - другой файл сети (например, сеть одной книги) вместо общей;
+#   lod, title           - параметры детализации и заголовок, как в интерактивном режиме.
+ATTRIBUTE_FILTERS = ('faculty', 'side', 'role', 'blood_status', 'species', 'loyalty')
+MAIN_FACULTIES = ('Гриффиндор', 'Слизерин', 'Когтевран', 'Пуффендуй')
+
+_state = {}
+
+
+def spec_name(spec):
+    name = spec.get('name')
+    if not name:
+        parts = [f"{key}-{spec[key]}" for key in ATTRIBUTE_FILTERS if spec.get(key)]
+        if spec.get('network'):
+            parts.insert(0, os.path.splitext(os.path.basename(spec['network']))[0])
+        if spec.get('ego'):
+            parts.append(f"ego-{spec['ego']}-{spec.get('radius', 1)}")
+        name = '_'.join(parts) or 'full'
+    return re.sub(r'[\\/:*?"<>|\s]+', '_', str(name))
+
+
+def matches(info, spec):
+    for key in ATTRIBUTE_FILTERS:
+        wanted = spec.get(key)
+        if not wanted:
+            continue
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        value = str(info.get(key, ''))
+        if not any(value.startswith(w) for w in wanted):
+            return False
+    return True
+
+
+def default_specs(G, character_data):
+    specs = [{'name': 'full'}]
+    for faculty in MAIN_FACULTIES:
+        specs.append({'name': f"faculty_{faculty}", 'faculty': faculty})
+    sides = sorted({character_data.get(node, {}).get('side') for node in G.nodes()} - {None})
+    for side in sides:
+        specs.append({'name': f"side_{side}", 'side': side})
+    for node in G.nodes():
+        if character_data.get(node, {}).get('role') == 'Главный':
+            specs.append({'name': f"ego_{node}", 'ego': node, 'radius': 1})
+    return specs
+
+
+def _init_worker(html_mode, G, character_data, pos):
+    # При fork данные наследуются без копирования, при spawn передаются один раз на процесс.
+    visualizer = HPNetworkVisualizer(None)
+    visualizer.html_mode = html_mode
+    _state.update(visualizer=visualizer, graph=G, character_data=character_data, pos=pos)
+
+
+def select_view(spec):
+    visualizer = _state['visualizer']
+    G, pos = _state['graph'], _state['pos']
+    character_data = _state['character_data']
+
+    if spec.get('network'):
+        G = visualizer.create_graph(visualizer.load_json(spec['network']))
+        known = {node: pos[node] for node in G.nodes() if node in pos}
+        if len(known) < G.number_of_nodes():
+            # Новые узлы раскладываются вокруг закреплённых узлов базовой раскладки.
+            pos = nx.spring_layout(G, k=0.5, iterations=50, seed=42,
+                                   pos=known or None, fixed=list(known) or None)
+
+    nodes = [node for node in G.nodes() if matches(character_data.get(node, {}), spec)]
+    view = G.subgraph(nodes)
+    if spec.get('ego'):
+        if spec['ego'] not in view:
+            return nx.Graph(), pos
+        view = nx.ego_graph(view, spec['ego'], radius=spec.get('radius', 1))
+    return view.copy(), pos
+
+
+def render_spec(spec, output_dir):
+    started = time.time()
+    visualizer = _state['visualizer']
+    name = spec_name(spec)
+    view, pos = select_view(spec)
+    if view.number_of_nodes() == 0:
+        return name, 0, 0, None, time.time() - started
+
+    fig = visualizer.build_figure(
+        view, pos, _state['character_data'], lod=spec.get('lod'),
+        title=spec.get('title', f'Социальная сеть персонажей "Гарри Поттера": {name}')
+    )
+    html_file = os.path.join(output_dir, f"{name}.html")
+    visualizer.write_figure(fig, html_file, visualizer.html_mode)
+    return name, view.number_of_nodes(), view.number_of_edges(), html_file, time.time() - started
+
+
+def render_batch(specs, network_path, character_path, output_dir, workers=None, html_mode='shared'):
+    visualizer = HPNetworkVisualizer(None)
+    visualizer.html_mode = html_mode
+
+    print("Загрузка данных...")
+    G = visualizer.create_graph(visualizer.load_json(network_path))
+    character_data = visualizer.load_json(character_path)
+
+    print("Расчёт базовой раскладки...")
+    pos = cached_layout(G, visualizer.layout_cache, get_layout_engine(visualizer.layout_engine, G),
+                        k=0.5, iterations=50, seed=42)
+    if specs is None:
+        specs = default_specs(G, character_data)
+
+    os.makedirs(output_dir, exist_ok=True)
+    if html_mode == 'shared':
+        # Общий plotly.js пишется заранее, чтобы процессы не писали его одновременно.
+        visualizer.plotly_asset(output_dir)
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Видов: {len(specs)}, процессов: {workers}")
+    started = time.time()
+    results = []
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(html_mode, G, character_data, pos)) as executor:
+        futures = [executor.submit(render_spec, spec, output_dir) for spec in specs]
+        for future in as_completed(futures):
+            name, nodes, edges, html_file, seconds = future.result()
+            if html_file is None:
+                print(f"  {name}: пустой вид, пропущен")
+            else:
+                print(f"  {name}: узлов {nodes}, рёбер {edges}, {seconds:.2f} с")
+            results.append((name, nodes, edges, html_file))
+    print(f"Готово за {time.time() - started:.2f} с, файлы в {output_dir}")
+    return results
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Пакетная отрисовка видов сети персонажей без окна")
+    parser.add_argument("--specs", help="JSON-файл со списком спецификаций видов "
+                                        "(по умолчанию: факультеты, стороны и эго-сети главных героев)")
+    parser.add_argument("--network", default=os.path.join(base_dir, "data", "precise_character_network.json"),
+                        help="Файл сети персонажей")
+    parser.add_argument("--characters", default=os.path.join(base_dir, "data", "character_info_with_roles.json"),
+                        help="Файл с информацией о персонажах")
+    parser.add_argument("--output-dir", default="renders", help="Каталог для HTML-файлов")
+    parser.add_argument("--workers", type=int, default=None, help="Число процессов")
+    parser.add_argument("--html-mode", choices=["shared", "embedded"], default="shared",
+                        help="shared - общий plotly.js в каталоге, embedded - библиотека в каждом файле")
+    args = parser.parse_args()
+
+    specs = None
+    if args.specs:
+        with open(args.specs, 'r', encoding='utf-8') as f:
+            specs = json.load(f)
+    render_batch(specs, args.network, args.characters, args.output_dir, args.workers, args.html_mode)
+
+
+if __name__ == "__main__":
+    main()
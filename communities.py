@@ -0,0 +1,97 @@
+from collections import Counter
+import numpy as np
+import networkx as nx
+from graph_layout import LayoutCache
+
+COMMUNITY_METHODS = ('louvain', 'label_propagation')
+
+
+def detect_communities(G, method='louvain', seed=42, resolution=1.0, weight='weight'):
+    # Номера сообществ упорядочены по убыванию размера: 0 - самое большое.
+    if G.number_of_nodes() == 0:
+        return {}
+    if method == 'louvain':
+        groups = nx.community.louvain_communities(G, weight=weight, resolution=resolution, seed=seed)
+    elif method == 'label_propagation':
+        groups = nx.community.fast_label_propagation_communities(G, weight=weight, seed=seed)
+    else:
+        raise ValueError(f"Неизвестный метод поиска сообществ: {method}")
+    groups = sorted((sorted(map(str, group)) for group in groups), key=lambda group: (-len(group), group))
+    index = {str(node): node for node in G.nodes()}
+    return {index[name]: community for community, group in enumerate(groups) for name in group}
+
+
+class CommunityCache(LayoutCache):
+    # Разбиение кэшируется так же, как раскладка: ключ - хэш графа и параметров.
+    def encode(self, community):
+        return int(community)
+
+    def decode(self, value):
+        return int(value)
+
+
+def cached_communities(G, cache, method='louvain', seed=42, resolution=1.0):
+    params = dict(method=method, seed=seed, resolution=resolution)
+    key = cache.key(G, params)
+    membership = cache.load(key)
+    if membership is not None and all(node in membership for node in G.nodes()):
+        return membership
+    membership = detect_communities(G, method, seed, resolution)
+    cache.save(key, membership)
+    return membership
+
+
+def community_label(community, size):
+    return f"Сообщество {community + 1} ({size})"
+
+
+def collapse(G, membership, expanded=()):
+    # Узлы нераскрытых сообществ сливаются в один супер-узел, веса рёбер между
+    # получившимися узлами суммируются, рёбра внутри супер-узла отбрасываются.
+    sizes = Counter(membership.values())
+    expanded = set(expanded)
+
+    def key(node):
+        community = membership[node]
+        return node if community in expanded else community_label(community, sizes[community])
+
+    H = nx.Graph()
+    for node in G.nodes():
+        community = membership[node]
+        H.add_node(key(node), community=community,
+                   members=1 if community in expanded else sizes[community])
+
+    edges = list(G.edges(data='weight', default=1.0))
+    if edges:
+        keys = list(H.nodes())
+        ids = {name: i for i, name in enumerate(keys)}
+        rows = np.array([ids[key(u)] for u, _, _ in edges], dtype=np.int64)
+        cols = np.array([ids[key(v)] for _, v, _ in edges], dtype=np.int64)
+        weights = np.array([w for _, _, w in edges], dtype=float)
+        outer = rows != cols
+        low = np.minimum(rows[outer], cols[outer])
+        high = np.maximum(rows[outer], cols[outer])
+        pairs, inverse = np.unique(np.stack([low, high], axis=1), axis=0, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=weights[outer], minlength=len(pairs))
+        H.add_weighted_edges_from((keys[i], keys[j], float(w)) for (i, j), w in zip(pairs.tolist(), sums))
+    return H
+
+
+def community_summary(G, membership, character_info):
+    # Атрибуты супер-узла для подсказки и цвета: преобладающие сторона и факультет.
+    members = {}
+    for node, community in membership.items():
+        members.setdefault(community, []).append(node)
+    degrees = dict(G.degree(weight='weight'))
+    summary = {}
+    for community, nodes in members.items():
+        nodes.sort(key=lambda node: -degrees.get(node, 0))
+        sides = Counter(character_info.get(node, {}).get('side', 'unknown') for node in nodes)
+        faculties = Counter(character_info.get(node, {}).get('faculty', 'неизвестно') for node in nodes)
+        summary[community_label(community, len(nodes))] = {
+            'side': sides.most_common(1)[0][0],
+            'faculty': faculties.most_common(1)[0][0],
+            'role': f"Сообщество из {len(nodes)} персонажей",
+            'members': ', '.join(nodes[:5]) + (' и др.' if len(nodes) > 5 else ''),
+        }
+    return summary
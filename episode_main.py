@@ -1,15 +1,139 @@
 import json
+import numpy as np
+import scipy.sparse as sp
+from graph_store import GraphStore, binary_path, load_data, open_store, write_store
 
 
-def determine_roles(network_file, character_file, output_file):
-    with open(network_file, 'r', encoding='utf-8') as f:
-        network_data = json.load(f)
+def build_adjacency(network_data):
+    if isinstance(network_data, GraphStore):
+        # CSR из memmap берётся как есть, без построения словарей.
+        n = len(network_data.names)
+        adjacency = sp.csr_matrix(
+            (network_data.weights(), np.asarray(network_data.arrays['indices']), network_data.square_indptr()),
+            shape=(n, n))
+        adjacency.setdiag(0)
+        adjacency.eliminate_zeros()
+        return network_data.names, adjacency.maximum(adjacency.T).tocsr()
 
-    with open(character_file, 'r', encoding='utf-8') as f:
-        character_data = json.load(f)
+    names = sorted(set(network_data) | {other for links in network_data.values() for other in links})
+    index = {name: i for i, name in enumerate(names)}
+    rows, cols, weights = [], [], []
+    for char, relations in network_data.items():
+        for other, weight in relations.items():
+            if char != other:
+                rows.append(index[char])
+                cols.append(index[other])
+                weights.append(float(weight))
+    n = len(names)
+    adjacency = sp.csr_matrix((weights, (rows, cols)), shape=(n, n))
+    # Сеть неориентированная: берём максимум из двух направлений, если в JSON они расходятся.
+    adjacency = adjacency.maximum(adjacency.T).tocsr()
+    return names, adjacency
+
+
+def pagerank(adjacency, alpha=0.85, tol=1e-10, max_iter=200):
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.empty(0)
+    strength = np.asarray(adjacency.sum(axis=1)).ravel()
+    dangling = strength == 0
+    inv_strength = np.where(dangling, 0.0, 1.0 / np.where(dangling, 1.0, strength))
+    transition = sp.diags(inv_strength) @ adjacency
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        new_rank = alpha * (transition.T @ rank + rank[dangling].sum() / n) + (1 - alpha) / n
+        if np.abs(new_rank - rank).sum() < tol:
+            return new_rank
+        rank = new_rank
+    return rank
+
+
+def approximate_betweenness(adjacency, pivots=256, seed=42, batch=32):
+    # Алгоритм Брандеса в матричной форме: обход в ширину сразу из пачки опорных вершин
+    # (sparse-умножение на каждом уровне) и обратное накопление зависимостей по уровням.
+    # При pivots >= n результат точный, иначе это несмещённая оценка по выборке из pivots
+    # источников. Кратчайшие пути считаются по числу рёбер, вес учитывают степень и PageRank.
+    n = adjacency.shape[0]
+    if n == 0:
+        return np.empty(0)
+    links = adjacency.copy()
+    links.data = np.ones_like(links.data)
+    links = links.tocsr()
+
+    rng = np.random.default_rng(seed)
+    sources = np.arange(n) if pivots >= n else rng.choice(n, size=pivots, replace=False)
+    betweenness = np.zeros(n)
+
+    for start in range(0, len(sources), batch):
+        batch_sources = sources[start:start + batch]
+        k = len(batch_sources)
+        sigma = np.zeros((k, n))
+        sigma[np.arange(k), batch_sources] = 1.0
+        visited = sigma > 0
+        frontier = sigma.copy()
+        levels = []
+        while True:
+            reached = np.asarray((links.T @ frontier.T).T)
+            reached[visited] = 0.0
+            new = reached > 0
+            if not new.any():
+                break
+            sigma += reached
+            visited |= new
+            levels.append(new)
+            frontier = reached
+
+        delta = np.zeros((k, n))
+        # Зависимость источника от самого себя не нужна, поэтому первый уровень пропускаем.
+        for depth in range(len(levels) - 1, 0, -1):
+            level = levels[depth]
+            share = np.where(level, (1.0 + delta) / np.where(level, sigma, 1.0), 0.0)
+            delta += np.where(levels[depth - 1], sigma * np.asarray((links @ share.T).T), 0.0)
+
+        betweenness += delta.sum(axis=0)
+
+    betweenness *= n / len(sources)
+    betweenness /= 2.0
+    if n > 2:
+        betweenness /= (n - 1) * (n - 2) / 2.0
+    return betweenness
+
+
+def centrality_scores(network_data, pivots=256, seed=42):
+    names, adjacency = build_adjacency(network_data)
+    weighted_degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    scores = {
+        'weighted_degree': weighted_degree,
+        'pagerank': pagerank(adjacency),
+        'betweenness': approximate_betweenness(adjacency, pivots=pivots, seed=seed),
+    }
+    return names, scores
+
+
+def determine_roles(network_file, character_file, output_file, method='centrality', pivots=256):
+    network_data = open_store(network_file) if method == 'centrality' else None
+    if network_data is None:
+        network_data = load_data(network_file)
+    character_data = load_data(character_file)
+
+    if method == 'centrality':
+        # Каждая метрика делится на своё среднее, итоговая оценка - среднее трёх отношений;
+        # пороги 1.5 и 0.7 от среднего те же, что и у подсчёта соседей.
+        names, scores = centrality_scores(network_data, pivots=pivots)
+        index = {name: i for i, name in enumerate(names)}
+        relative = [values / values.mean() if len(values) and values.mean() > 0 else np.zeros(len(values))
+                    for values in scores.values()]
+        combined = np.mean(relative, axis=0) if names else np.empty(0)
+        connection_counts = {name: combined[i] for name, i in index.items()}
+        avg_connections = 1.0 if names else 0
+        for char in character_data:
+            i = index.get(char)
+            for key, values in scores.items():
+                character_data[char][key] = round(float(values[i]), 6) if i is not None else 0.0
+    else:
+        connection_counts = {char: len(relations) for char, relations in network_data.items()}
+        avg_connections = sum(connection_counts.values()) / len(connection_counts) if connection_counts else 0
 
-    connection_counts = {char: len(relations) for char, relations in network_data.items()}
-    avg_connections = sum(connection_counts.values()) / len(connection_counts) if connection_counts else 0
     for char in character_data:
         count = connection_counts.get(char, 0)
         if count > avg_connections * 1.5:
@@ -20,6 +144,7 @@ def determine_roles(network_file, character_file, output_file):
             character_data[char]['role'] = 'Эпизодический'
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(character_data, f, ensure_ascii=False, indent=2)
+    write_store(binary_path(output_file), attributes=character_data)
 
 
 if __name__ == "__main__":
@@ -1,25 +1,172 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, SoupStrainer
 import re
+import os
 import json
 import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-
-def clean_text(text):
-    while '[' in text and ']' in text:
-        start = text.index('[')
-        end = text.index(']') + 1
-        text = text[:start] + text[end:]
-    return text.strip()
+WIKI_URL = "https://harrypotter.fandom.com/ru/wiki/"
+
+NAME_RE = re.compile(r'^[А-ЯЁ][а-яё]+\s[А-ЯЁ][а-яё]+$')
+
+try:
+    import lxml  # noqa: F401
+    FAST_PARSER = 'lxml'
+except ImportError:
+    FAST_PARSER = 'html.parser'
+
+LIST_PAGES = [
+    "Гарри_Поттер_и_Философский_камень_(персонажи)",
+    "Гарри_Поттер_и_Тайная_комната_(персонажи)",
+    "Гарри_Поттер_и_Узник_Азкабана_(персонажи)",
+    "Гарри_Поттер_и_Кубок_огня_(персонажи)",
+    "Гарри_Поттер_и_Орден_Феникса_(персонажи)",
+    "Гарри_Поттер_и_Принц-полукровка_(персонажи)",
+    "Гарри_Поттер_и_Дары_Смерти_(персонажи)"
+]
+
+
+class TokenBucket:
+    # Не больше rate запросов в секунду в среднем, всплеск до capacity запросов.
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_session(pool_size=8, retries=3, backoff=1.0):
+    # Одна сессия на весь запуск: соединения с сервером переиспользуются, а временные
+    # ошибки (429, 5xx, обрыв соединения) повторяются с экспоненциальной паузой.
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD"),
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch(url, session=None, limiter=None, timeout=15):
+    if limiter is not None:
+        limiter.acquire()
+    return (session or requests).get(url, timeout=timeout)
+
+
+class ResponseCache:
+    # Ответы вики хранятся на диске по URL вместе с ETag и Last-Modified. Повторный запуск
+    # отправляет условный запрос и получает 304 для неизменившихся страниц, а в режиме
+    # offline обходится без сети вовсе. fetch возвращает (текст, изменилась ли страница).
+    def __init__(self, cache_dir, offline=False):
+        self.cache_dir = cache_dir
+        self.offline = offline
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.html"), os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, url):
+        body_path, meta_path = self.paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(body_path, 'r', encoding='utf-8') as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None, None
+
+    def save(self, url, response):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        body_path, meta_path = self.paths(url)
+        meta = {
+            'url': url,
+            'final_url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched': time.time()
+        }
+        with open(body_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(response.text)
+        os.replace(body_path + '.tmp', body_path)
+        with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(meta_path + '.tmp', meta_path)
+        return meta
+
+    def fetch(self, url, session=None, limiter=None, timeout=15):
+        text, meta = self.load(url)
+        if self.offline:
+            return text, False
+
+        headers = {}
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        if limiter is not None:
+            limiter.acquire()
+        response = (session or requests).get(url, timeout=timeout, headers=headers)
+        if response.status_code == 304 and text is not None:
+            return text, False
+        response.raise_for_status()
+        self.save(url, response)
+        return response.text, True
 
 
-def names(html):
-    soup = BeautifulSoup(html, 'html.parser')
+def clean_text(text):
+    # Сноски вида [1] вырезаются за один проход: от каждой '[' до ближайшей следующей ']'.
+    if '[' not in text:
+        return text.strip()
+    parts = []
+    pos = 0
+    while True:
+        start = text.find('[', pos)
+        if start < 0:
+            break
+        end = text.find(']', start)
+        if end < 0:
+            break
+        parts.append(text[pos:start])
+        pos = end + 1
+    parts.append(text[pos:])
+    return ''.join(parts).strip()
+
+
+def names(html, fast=True):
+    if fast:
+        soup = BeautifulSoup(html, FAST_PARSER, parse_only=SoupStrainer('li'))
+    else:
+        soup = BeautifulSoup(html, 'html.parser')
     characters = set()
     for el in soup.find_all('li'):
         text = clean_text(el.get_text(strip=True))
-        if re.match(r'^[А-ЯЁ][а-яё]+\s[А-ЯЁ][а-яё]+$', text):
+        if NAME_RE.match(text):
             characters.add(text)
     return characters
 
@@ -46,68 +193,163 @@ def determine_side(loyalty_text):
     return "Нейтральный"
 
 
-def get_character_info(name):
+def character_url(name, base_url=WIKI_URL):
+    return base_url + name.replace(' ', '_')
+
+
+def get_character_info(name, session=None, limiter=None, base_url=WIKI_URL, cache=None, previous=None):
+    # С кэшем ответов карточка разбирается заново, только если страница изменилась.
+    # При ошибке загрузки остаётся прежняя карточка, чтобы персонаж не пропал из файла.
     try:
-        url = f"https://harrypotter.fandom.com/ru/wiki/{name.replace(' ', '_')}"
-        response = requests.get(url, timeout=15)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        infobox = soup.find('aside', {'class': 'portable-infobox'})
-        if not infobox:
-            return None
-
-        info = {
-            'faculty': 'Не указан',
-            'side': 'Нейтральный',
-            'blood_status': 'Неизвестно',
-            'species': 'Человек',
-            'loyalty': 'Не указана'
-        }
+        url = character_url(name, base_url)
+        if cache is None:
+            return parse_character_info(fetch(url, session, limiter, timeout=15).text)
 
-        for row in infobox.find_all('div', {'class': 'pi-item'}):
-            if not row.find('h3'):
-                continue
+        text, changed = cache.fetch(url, session, limiter, timeout=15)
+        if text is None or (not changed and previous is not None):
+            return previous
+        return parse_character_info(text)
 
-            key = clean_text(row.find('h3').get_text(strip=True))
-            value = clean_text(row.find('div').get_text(' ', strip=True)) if row.find('div') else ''
+    except Exception as e:
+        print(f"Ошибка при обработке {name}: {str(e)}")
+        return previous
+
+
+def find_infobox(html):
+    # Быстрый путь: вырезать из страницы только <aside class="portable-infobox"> и разобрать
+    # этот фрагмент. Если разметка необычная, разбирается вся страница, но в дерево
+    # попадают только элементы <aside>.
+    start = html.find('<aside')
+    while start >= 0:
+        tag_end = html.find('>', start)
+        if tag_end < 0:
+            break
+        if 'portable-infobox' in html[start:tag_end]:
+            end = html.find('</aside>', tag_end)
+            if end >= 0 and '<aside' not in html[tag_end:end]:
+                soup = BeautifulSoup(html[start:end + len('</aside>')], FAST_PARSER)
+                return soup.find('aside', {'class': 'portable-infobox'})
+            break
+        start = html.find('<aside', tag_end)
+
+    soup = BeautifulSoup(html, FAST_PARSER, parse_only=SoupStrainer('aside'))
+    return soup.find('aside', {'class': 'portable-infobox'})
+
+
+def parse_character_info(html, fast=True):
+    if fast:
+        infobox = find_infobox(html)
+    else:
+        infobox = BeautifulSoup(html, 'html.parser').find('aside', {'class': 'portable-infobox'})
+    if not infobox:
+        return None
+
+    info = {
+        'faculty': 'Не указан',
+        'side': 'Нейтральный',
+        'blood_status': 'Неизвестно',
+        'species': 'Человек',
+        'loyalty': 'Не указана'
+    }
+
+    for row in infobox.find_all('div', {'class': 'pi-item'}):
+        if not row.find('h3'):
+            continue
 
-            if 'факультет' in key.lower():
-                info['faculty'] = value.split(',')[0].strip()
-            elif 'лояльность' in key.lower():
-                info['loyalty'] = value
-            elif 'чистота крови' in key.lower() or 'чистотакрови' in key.lower():
-                info['blood_status'] = value.split('(')[0].strip()
-            elif 'вид' in key.lower():
-                info['species'] = value.split(',')[0].strip()
+        key = clean_text(row.find('h3').get_text(strip=True))
+        value = clean_text(row.find('div').get_text(' ', strip=True)) if row.find('div') else ''
 
-        if info['loyalty'] != 'Не указана':
-            info['side'] = determine_side(info['loyalty'])
+        if 'факультет' in key.lower():
+            info['faculty'] = value.split(',')[0].strip()
+        elif 'лояльность' in key.lower():
+            info['loyalty'] = value
+        elif 'чистота крови' in key.lower() or 'чистотакрови' in key.lower():
+            info['blood_status'] = value.split('(')[0].strip()
+        elif 'вид' in key.lower():
+            info['species'] = value.split(',')[0].strip()
 
-        if not 'человек' in info['species'].lower():
-            info['faculty'] = 'Отсутствует'
-            info['blood_status'] = 'Нельзя определить'
-        elif info['blood_status'].lower() == 'магл':
-            info['faculty'] = 'Отсутствует'
+    if info['loyalty'] != 'Не указана':
+        info['side'] = determine_side(info['loyalty'])
 
-        return info
+    if not 'человек' in info['species'].lower():
+        info['faculty'] = 'Отсутствует'
+        info['blood_status'] = 'Нельзя определить'
+    elif info['blood_status'].lower() == 'магл':
+        info['faculty'] = 'Отсутствует'
+
+    return info
+
+
+def fetch_list_page(url, session=None, limiter=None, cache=None):
+    # None - страница недоступна (ошибка сети или её нет в кэше в режиме offline).
+    print(f"Обрабатывается {url}...")
+    try:
+        if cache is not None:
+            text, _ = cache.fetch(url, session, limiter, timeout=20)
+            if text is None:
+                print(f"Нет сохранённой страницы {url}")
+                return None
+            return names(text)
+
+        response = fetch(url, session, limiter, timeout=20)
+        response.raise_for_status()
+        if requests.utils.unquote(response.url) != url:
+            print(f"Произошёл редирект с {url} на {response.url}")
+        return names(response.text)
 
     except Exception as e:
-        print(f"Ошибка при обработке {name}: {str(e)}")
+        print(f"Ошибка: {str(e)}")
         return None
 
 
-def main():
-    urls = [
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Философский_камень_(персонажи)",
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Тайная_комната_(персонажи)",
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Узник_Азкабана_(персонажи)",
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Кубок_огня_(персонажи)",
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Орден_Феникса_(персонажи)",
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Принц-полукровка_(персонажи)",
-        "https://harrypotter.fandom.com/ru/wiki/Гарри_Поттер_и_Дары_Смерти_(персонажи)"
-    ]
+def benchmark_parsing(cache_dir="data/http_cache", repeat=3):
+    # Сравнение полного разбора html.parser с быстрым путём на сохранённых страницах кэша.
+    pages = []
+    if os.path.isdir(cache_dir):
+        for name in sorted(os.listdir(cache_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(cache_dir, name), 'r', encoding='utf-8') as f:
+                    pages.append(f.read())
+    if not pages:
+        print(f"Нет сохранённых страниц в {cache_dir}, сначала запустите сбор с кэшем")
+        return
+
+    for title, extract in (("карточки", parse_character_info), ("списки имён", names)):
+        results = {}
+        for fast in (False, True):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                results[fast] = [extract(page, fast) for page in pages]
+            elapsed = time.perf_counter() - start
+            label = f"быстрый разбор ({FAST_PARSER})" if fast else "полный разбор (html.parser)"
+            print(f"{title}, {label}: {len(pages) * repeat / elapsed:.1f} страниц/с")
+        print("  результаты совпадают" if results[False] == results[True] else "  результаты РАЗЛИЧАЮТСЯ")
+
+
+def load_previous_info(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_previous_characters(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+    except OSError:
+        return set()
+
+
+def main(base_url=WIKI_URL, workers=4, rate=2.0, output_dir="data", use_cache=True, offline=False):
+    # Страницы скачиваются параллельно (не больше workers одновременно) через общую сессию,
+    # а TokenBucket ограничивает темп запросов к вики вместо фиксированной паузы.
+    # Кэш ответов в data/http_cache позволяет не перекачивать и не разбирать неизменившиеся
+    # страницы, а character_info.json дополняется, а не собирается с нуля.
+    urls = [base_url + page for page in LIST_PAGES]
 
-    Path("data").mkdir(exist_ok=True)
+    Path(output_dir).mkdir(exist_ok=True)
     
     name_corrections = {
         'Мардж Дурсль': 'Марджори Дурсль',
@@ -116,44 +358,70 @@ def main():
         'Отец Хагрида': 'Мистер Хагрид'
     }
 
+    session = make_session(pool_size=workers)
+    limiter = TokenBucket(rate, capacity=workers)
+    cache = ResponseCache(f"{output_dir}/http_cache", offline) if use_cache or offline else None
+    info_path = f"{output_dir}/character_info.json"
+    previous_info = load_previous_info(info_path) if cache else {}
+    characters_path = f"{output_dir}/characters.txt"
     all_characters = set()
-
-    for url in urls:
-        print(f"Обрабатывается {url}...")
-
-        try:
-            response = requests.get(url, timeout=20)
-            response.raise_for_status()
-            if response.url != url:
-                print(f"Произошёл редирект с {url} на {response.url}")
-
-            all_characters.update(names(response.text))
-
-        except Exception as e:
-            print(f"Ошибка: {str(e)}")
-            continue
-
-    valid_characters = {c for c in all_characters if re.fullmatch(r'^[А-ЯЁ][а-яё]+\s[А-ЯЁ][а-яё]+$', c)}
-
-    with open("data/characters.txt", "w", encoding="utf-8") as f:
+    failed_pages = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page_characters in executor.map(lambda url: fetch_list_page(url, session, limiter, cache), urls):
+            if page_characters is None:
+                failed_pages += 1
+            else:
+                all_characters.update(page_characters)
+
+    # Недоступная страница списка не должна удалять персонажей: если не получено ни одной
+    # страницы, файлы не перезаписываются, а при частичной неудаче сохраняется прежний список.
+    if failed_pages == len(urls):
+        print(f"Не удалось получить ни одной страницы со списком персонажей, "
+              f"файлы в {output_dir} не изменены")
+        return
+    if failed_pages:
+        print(f"Недоступно страниц со списками: {failed_pages}, прежние персонажи сохранены")
+        all_characters |= load_previous_characters(characters_path)
+
+    valid_characters = {c for c in all_characters if NAME_RE.fullmatch(c)}
+
+    with open(characters_path, "w", encoding="utf-8") as f:
         f.write("\n".join(sorted(valid_characters)))
 
-    character_info = {}
-
-    for char in sorted(valid_characters):
+    def collect(char):
         corrected_name = name_corrections.get(char, char)
         print(f"Сбор информации для {corrected_name}...")
-        info = get_character_info(corrected_name)
-        if info:
-            character_info[char] = info
+        return char, get_character_info(corrected_name, session, limiter, base_url,
+                                        cache, previous_info.get(char))
+
+    character_info = {}
 
-        time.sleep(1.5)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for char, info in executor.map(collect, sorted(valid_characters)):
+            if info:
+                character_info[char] = info
 
-    with open("data/character_info.json", "w", encoding="utf-8") as f:
+    with open(info_path, "w", encoding="utf-8") as f:
         json.dump(character_info, f, ensure_ascii=False, indent=2)
 
     print(f"Собрана информация по {len(character_info)} персонажам")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Сбор списка персонажей и их карточек с вики")
+    parser.add_argument("--base-url", default=WIKI_URL,
+                        help="адрес вики (например, локальный сервер с сохранёнными страницами)")
+    parser.add_argument("--workers", type=int, default=4, help="число одновременных запросов")
+    parser.add_argument("--rate", type=float, default=2.0, help="не больше N запросов в секунду")
+    parser.add_argument("--output-dir", default="data", help="куда сохранять результаты")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш ответов вики")
+    parser.add_argument("--offline", action="store_true", help="брать страницы только из кэша, без сети")
+    parser.add_argument("--benchmark-parsing", action="store_true",
+                        help="сравнить скорость полного и быстрого разбора сохранённых страниц и выйти")
+    args = parser.parse_args()
+    if args.benchmark_parsing:
+        benchmark_parsing(f"{args.output_dir}/http_cache")
+    else:
+        main(base_url=args.base_url, workers=args.workers, rate=args.rate, output_dir=args.output_dir,
+             use_cache=not args.no_cache, offline=args.offline)
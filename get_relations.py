@@ -1,59 +1,196 @@
 import os
 import json
+import time
+import bisect
+import hashlib
+import argparse
+import threading
+import numpy as np
 import spacy
+from spacy.attrs import ORTH, IS_PUNCT, IS_SPACE
+from spacy.matcher import PhraseMatcher
+from spacy.tokens import DocBin
+from spacy.util import filter_spans
 from collections import defaultdict, Counter
 from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from graph_store import binary_path, write_store
+from temporal_network import ChapterTimeline, SeriesTimeline, TIMELINE_MODES, display_name
 
-nlp = spacy.load("ru_core_news_lg")
-nlp.max_length = 3000000
+try:
+    import pymorphy3
+except ImportError:
+    pymorphy3 = None
 
+# Из конвейера нужны только границы предложений (parser) и именованные сущности (ner).
+UNUSED_COMPONENTS = ["morphologizer", "attribute_ruler", "lemmatizer"]
+MAX_LENGTH = 3000000
 
-class CharacterResolver:
-    def __init__(self, character_file):
-        self.characters = set()
-        self.name_variants = defaultdict(set)
-        self.primary_names = {}
-        self.load_characters(character_file)
-        self.pronouns = {
-            'он': 'male', 'она': 'female', 'они': 'plural',
-            'его': 'male', 'её': 'female', 'их': 'plural'
-        }
-        self.context_window = []
-        self.max_context_size = 5
-        self.gender_cache = {}
-        self.dialogue_participants = set()
-        self.in_dialogue = False
-        self.dialogue_started = False
 
-    def load_characters(self, file_path):
-        with open(file_path, 'r', encoding='utf-8') as f:
+@lru_cache(maxsize=None)
+def load_pipeline(name="ru_core_news_lg"):
+    # "blank" - только токенизатор и sentencizer, без нейросетевых компонентов.
+    if name == "blank":
+        pipeline = spacy.blank("ru")
+        pipeline.add_pipe("sentencizer")
+    else:
+        pipeline = spacy.load(name, exclude=UNUSED_COMPONENTS)
+    pipeline.max_length = MAX_LENGTH
+    return pipeline
+
+
+# Падежные окончания для грубого стемминга, когда pymorphy3 не установлен.
+CASE_ENDINGS = ("ами", "ями", "ого", "его", "ому", "ему", "ой", "ей", "ом", "ем", "ым", "им",
+                "ых", "их", "ою", "ею", "ую", "юю", "ая", "яя", "ы", "и", "а", "я", "у", "ю", "е", "о")
+# Окончания именительного падежа, которых нет среди падежных: "Гораций" -> "горац" (как
+# "Горация"), "Алексей" -> "алексе" (как "Алексея"), "Игорь" -> "игор".
+NOMINATIVE_ENDINGS = ("ий", "ей", "ой", "й", "ь")
+
+
+@lru_cache(maxsize=None)
+def morph_analyzer():
+    return pymorphy3.MorphAnalyzer() if pymorphy3 else None
+
+
+def name_stem(word):
+    for ending in CASE_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def name_stems(word):
+    # Все основы, под которыми имя из characters.txt ищется при стемминге падежных форм.
+    stems = {name_stem(word)}
+    for ending in NOMINATIVE_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            stems.add(word[:-len(ending)])
+    return stems
+
+
+class CharacterIndex:
+    # Неизменяемый индекс имён, общий для всех книг и потоков. Варианты имени хранятся
+    # отсортированными кортежами, чтобы выбор по умолчанию не зависел от порядка обхода set.
+    # Падежные формы ("Гарри Поттера", "Дамблдору") приводятся к именам из characters.txt
+    # через pymorphy3 или стемминг; результат нормализации кэшируется в ограниченном LRU.
+    def __init__(self, character_file, normalize_cache_size=65536):
+        characters = set()
+        name_variants = defaultdict(set)
+        with open(character_file, 'r', encoding='utf-8') as f:
             for line in f:
                 full_name = line.strip().lower()
                 if not full_name:
                     continue
-                self.characters.add(full_name)
-                self.primary_names[full_name] = full_name
+                characters.add(full_name)
                 parts = full_name.split()
                 variants = {full_name, parts[0], parts[-1]} if len(parts) > 1 else {full_name}
                 for variant in variants:
-                    self.name_variants[variant].add(full_name)
+                    name_variants[variant].add(full_name)
 
-    def resolve_name(self, text):
+        self.characters = frozenset(characters)
+        self.names = tuple(sorted(characters))
+        self.primary_names = {name: name for name in self.names}
+        self.name_variants = {variant: tuple(sorted(names))
+                              for variant, names in name_variants.items()}
+        self.pronouns = {
+            'он': 'male', 'она': 'female', 'они': 'plural',
+            'его': 'male', 'её': 'female', 'их': 'plural'
+        }
+
+        self.name_words = frozenset(word for variant in self.name_variants for word in variant.split())
+        word_stems = defaultdict(set)
+        for word in self.name_words:
+            for stem in name_stems(word):
+                word_stems[stem].add(word)
+        self.word_stems = {stem: min(words) for stem, words in word_stems.items()}
+        self.normalize = lru_cache(maxsize=normalize_cache_size)(self._normalize)
+        self.stats = Counter()
+
+    def normalize_word(self, word):
+        if word in self.name_words:
+            return word
+        morph = morph_analyzer()
+        if morph is not None:
+            for parse in morph.parse(word):
+                if parse.normal_form in self.name_words:
+                    return parse.normal_form
+        return self.word_stems.get(name_stem(word), word)
+
+    def _normalize(self, text):
+        return ' '.join(self.normalize_word(word) for word in text.split())
+
+    def resolve_stats(self):
+        cache = self.normalize.cache_info()
+        lookups = self.stats['lookups']
+        cache_lookups = cache.hits + cache.misses
+        return {
+            'lookups': lookups,
+            'resolved': self.stats['resolved'],
+            'resolved_by_normalization': self.stats['normalized'],
+            'resolve_hit_rate': self.stats['resolved'] / lookups if lookups else 0.0,
+            'cache_hits': cache.hits,
+            'cache_misses': cache.misses,
+            'cache_size': cache.currsize,
+            'cache_hit_rate': cache.hits / cache_lookups if cache_lookups else 0.0,
+        }
+
+    def resolve(self, text, context_window=()):
         if not text:
             return None
-        text = text.lower().strip()
+        self.stats['lookups'] += 1
+        text = ' '.join(text.lower().split())
+        if text not in self.characters and text not in self.name_variants:
+            text = self.normalize(text)
+            if text in self.characters or text in self.name_variants:
+                self.stats['normalized'] += 1
+        name = self._lookup(text, context_window)
+        if name:
+            self.stats['resolved'] += 1
+        return name
+
+    def _lookup(self, text, context_window):
         if text in self.characters:
             return self.primary_names[text]
         if text in self.name_variants:
             variants = self.name_variants[text]
             if variants:
-                for recent in reversed(self.context_window):
+                for recent in reversed(context_window):
                     if recent in variants:
                         return self.primary_names[recent]
-                return self.primary_names[next(iter(variants))]
+                return self.primary_names[variants[0]]
 
         return None
 
+
+class CharacterResolver:
+    # Состояние разбора одного документа (контекст упоминаний и диалог) поверх общего
+    # CharacterIndex. Для каждой книги создаётся свой экземпляр через for_document(),
+    # поэтому параллельные книги не портят состояние друг друга.
+    def __init__(self, character_file_or_index):
+        if isinstance(character_file_or_index, CharacterIndex):
+            self.index = character_file_or_index
+        else:
+            self.index = CharacterIndex(character_file_or_index)
+        self.characters = self.index.characters
+        self.name_variants = self.index.name_variants
+        self.primary_names = self.index.primary_names
+        self.pronouns = self.index.pronouns
+        self.max_context_size = 5
+        self.gender_cache = {}
+        self.reset_state()
+
+    def for_document(self):
+        return CharacterResolver(self.index)
+
+    def reset_state(self):
+        self.context_window = []
+        self.dialogue_participants = set()
+        self.in_dialogue = False
+        self.dialogue_started = False
+
+    def resolve_name(self, text):
+        return self.index.resolve(text, self.context_window)
+
     def update_context(self, character):
         if character and character in self.primary_names:
             canonical_name = self.primary_names[character]
@@ -91,83 +228,698 @@ class CharacterResolver:
         return []
 
 
-def analyze_interactions(doc, resolver):
-    interactions = defaultdict(Counter)
-    current_section_chars = set()
+DIALOGUE_ENDINGS = ('.', '!', '?', '…')
+
+
+def dialogue_boundaries(doc, in_dialogue=False):
+    # Векторный вариант CharacterResolver.process_dialogue для целого документа.
+    # Тире после пунктуации, пробельного токена или в начале документа открывает реплику,
+    # конец предложения без тире следом закрывает её, если реплика открыта. Ветка
+    # "тире между пробелами" в process_dialogue недостижима (её перехватывает открытие),
+    # а dialogue_started всегда совпадает с in_dialogue, поэтому хватает одного флага.
+    # Возвращает индексы открытий, сбрасывающих участников, индексы закрытий и итоговое
+    # состояние in_dialogue для следующего куска книги.
+    n = len(doc)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, in_dialogue
 
+    attrs = doc.to_array([ORTH, IS_PUNCT, IS_SPACE])
+    orth = attrs[:, 0]
+    boundary = (attrs[:, 1] != 0) | (attrs[:, 2] != 0)
+    dash = orth == doc.vocab.strings['—']
+    endings = np.isin(orth, [doc.vocab.strings[text] for text in DIALOGUE_ENDINGS])
+
+    opens = dash & np.concatenate(([True], boundary[:-1]))
+    candidates = endings & ~np.concatenate((dash[1:], [False]))
+
+    index = np.arange(n)
+    last_open = np.maximum.accumulate(np.where(opens, index, -1))
+    last_candidate = np.maximum.accumulate(np.where(candidates, index, -1))
+    prev_open = np.concatenate(([-1], last_open[:-1]))
+    prev_candidate = np.concatenate(([-1], last_candidate[:-1]))
+    active = (prev_open > prev_candidate) | ((prev_open < 0) & (prev_candidate < 0) & in_dialogue)
+
+    resets = np.flatnonzero(opens & ~active)
+    closes = np.flatnonzero(candidates & active)
+    if last_open[-1] >= 0 or last_candidate[-1] >= 0:
+        in_dialogue = bool(last_open[-1] > last_candidate[-1])
+    return resets, closes, in_dialogue
+
+
+def sentence_mentions(doc, spans):
+    starts = [span.start for span in spans]
     for sent in doc.sents:
+        lo = bisect.bisect_left(starts, sent.start)
+        hi = bisect.bisect_left(starts, sent.end)
+        yield spans[lo:hi]
+
+
+def ner_mentions(doc):
+    for sent in doc.sents:
+        yield [ent for ent in sent.ents if ent.label_ == 'PER']
+
+
+class NerMentions:
+    # Упоминания персонажей - сущности PER из модели ru_core_news_lg.
+    name = 'ner'
+
+    def __init__(self, index=None, model="ru_core_news_lg"):
+        self.nlp = load_pipeline(model)
+
+    def spans(self, doc):
+        return [ent for ent in doc.ents if ent.label_ == 'PER']
+
+    def __call__(self, doc):
+        return ner_mentions(doc)
+
+
+class PhraseMentions:
+    # Упоминания ищутся PhraseMatcher по всем вариантам имён из characters.txt без NER:
+    # хватает токенизатора и sentencizer. Совпадение засчитывается, только если первое
+    # слово написано с заглавной буквы - иначе варианты вроде "мистер" ловили бы любой текст.
+    name = 'matcher'
+
+    def __init__(self, index, model="blank"):
+        self.nlp = load_pipeline(model)
+        self.matcher = PhraseMatcher(self.nlp.vocab, attr="LOWER")
+        self.matcher.add("PER", [self.nlp.make_doc(variant) for variant in sorted(index.name_variants)])
+
+    def spans(self, doc):
+        spans = filter_spans(self.matcher(doc, as_spans=True))
+        return [span for span in spans if span[0].text[:1].isupper()]
+
+    def __call__(self, doc):
+        return sentence_mentions(doc, self.spans(doc))
+
+
+MENTION_ENGINES = {
+    'ner': NerMentions,
+    'matcher': PhraseMentions,
+}
+
+
+class CooccurrenceMatrix:
+    # Веса связей в симметричной матрице numpy: персонажи интернированы в целые id
+    # (порядок CharacterIndex.names), книги сливаются сложением матриц, а словари
+    # имён строятся только при сохранении.
+    def __init__(self, names, weights=None):
+        self.names = tuple(names)
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        if weights is None:
+            weights = np.zeros((len(self.names), len(self.names)))
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iadd__(self, other):
+        if other.names != self.names:
+            raise ValueError("Матрицы построены по разным спискам персонажей")
+        self.weights += other.weights
+        return self
+
+    def __eq__(self, other):
+        return (isinstance(other, CooccurrenceMatrix) and self.names == other.names
+                and np.array_equal(self.weights, other.weights))
+
+    def add_pairs(self, rows, cols, weights):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        weights = np.asarray(weights, dtype=float)
+        np.add.at(self.weights, (rows, cols), weights)
+        np.add.at(self.weights, (cols, rows), weights)
+
+    def subset(self, mask):
+        keep = np.flatnonzero(mask)
+        return CooccurrenceMatrix([self.names[i] for i in keep], self.weights[np.ix_(keep, keep)])
+
+    def to_relations(self):
+        relations = {}
+        for i, name in enumerate(self.names):
+            links = np.flatnonzero(self.weights[i])
+            relations[name] = {self.names[j]: float(self.weights[i, j]) for j in links}
+        return relations
+
+    @classmethod
+    def from_relations(cls, relations, names=None):
+        if names is None:
+            names = sorted(set(relations) | {other for links in relations.values() for other in links})
+        matrix = cls(names)
+        for char, links in relations.items():
+            for other, weight in links.items():
+                matrix.weights[matrix.ids[char], matrix.ids[other]] += weight
+        return matrix
+
+
+class MentionLog:
+    # Разрешённые упоминания книги в порядке текста: позиция токена и номер предложения
+    # считаются от начала книги, поэтому куски одной книги складываются в один журнал.
+    def __init__(self):
+        self.tokens = []
+        self.sentences = []
+        self.chars = []
+        self.token_offset = 0
+        self.sentence_offset = 0
+
+    def add(self, token, sentence, char_id):
+        self.tokens.append(self.token_offset + token)
+        self.sentences.append(self.sentence_offset + sentence)
+        self.chars.append(char_id)
+
+    def end_document(self, n_tokens, n_sentences):
+        self.token_offset += n_tokens
+        self.sentence_offset += n_sentences
+
+
+WINDOW_DECAYS = {
+    'none': lambda distance, window: np.ones_like(distance, dtype=float),
+    'linear': lambda distance, window: 1.0 - distance / (window + 1.0),
+    'exp': lambda distance, window: 0.5 ** (distance / max(window / 2.0, 1.0)),
+}
+
+
+class WindowedCooccurrence:
+    # Связи между упоминаниями на расстоянии не больше окна (в токенах или предложениях)
+    # с весом, убывающим с расстоянием. Пары строятся один раз по отсортированным позициям
+    # для самого большого окна, а сети для меньших окон получаются фильтрацией расстояний.
+    def __init__(self, names, windows=(10, 50), unit='tokens', decay='linear'):
+        self.windows = tuple(sorted(set(windows)))
+        self.unit = unit
+        self.decay = WINDOW_DECAYS[decay]
+        self.decay_name = decay
+        self.networks = {window: CooccurrenceMatrix(names) for window in self.windows}
+        self.lock = threading.Lock()
+
+    def pairs(self, log):
+        positions = np.asarray(log.tokens if self.unit == 'tokens' else log.sentences, dtype=np.int64)
+        chars = np.asarray(log.chars, dtype=np.int64)
+        max_window = self.windows[-1]
+        rows, cols, distances = [], [], []
+        for k in range(1, len(positions)):
+            distance = positions[k:] - positions[:-k]
+            near = np.flatnonzero(distance <= max_window)
+            if not len(near):
+                break
+            rows.append(chars[near])
+            cols.append(chars[near + k])
+            distances.append(distance[near])
+        if not rows:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        rows, cols, distances = np.concatenate(rows), np.concatenate(cols), np.concatenate(distances)
+        different = rows != cols
+        return rows[different], cols[different], distances[different]
+
+    def book_networks(self, log):
+        rows, cols, distances = self.pairs(log)
+        networks = {}
+        for window, network in self.networks.items():
+            inside = distances <= window
+            networks[window] = CooccurrenceMatrix(network.names)
+            networks[window].add_pairs(rows[inside], cols[inside],
+                                       self.decay(distances[inside], window))
+        return networks
+
+    def add_book(self, log):
+        networks = self.book_networks(log)
+        with self.lock:
+            for window, network in networks.items():
+                self.networks[window] += network
+        return networks
+
+    def name(self, window):
+        return f"{window}{'t' if self.unit == 'tokens' else 's'}"
+
+
+def analyze_interactions(doc, resolver, mentions=None, interactions=None, mention_log=None, timeline=None):
+    if interactions is None:
+        interactions = CooccurrenceMatrix(resolver.index.names)
+    ids = interactions.ids
+    rows, cols, pair_weights = [], [], []
+    current_section_chars = set()
+    if mentions is None:
+        mentions = ner_mentions
+
+    pair_chapters = []
+    if timeline is not None:
+        timeline.begin_document(doc.text)
+
+    resets, closes, in_dialogue = dialogue_boundaries(doc, resolver.in_dialogue)
+    events = sorted([(i, False) for i in resets.tolist()] + [(i, True) for i in closes.tolist()])
+    event_pos = 0
+
+    n_sentences = 0
+    for sentence_index, (sent, spans) in enumerate(zip(doc.sents, mentions(doc))):
+        n_sentences = sentence_index + 1
         dialogue_interactions = []
-        for token in sent:
-            participants = resolver.process_dialogue(token)
-            if participants:
+        while event_pos < len(events) and events[event_pos][0] < sent.end:
+            is_close = events[event_pos][1]
+            participants = list(resolver.dialogue_participants)
+            resolver.dialogue_participants = set()
+            if is_close and participants:
                 dialogue_interactions.extend(participants)
+            event_pos += 1
         sent_chars = set()
-        for ent in sent.ents:
-            if ent.label_ == 'PER':
-                char = resolver.resolve_name(ent.text)
-                if char:
-                    sent_chars.add(char)
-                    resolver.update_context(char)
+        for span in spans:
+            char = resolver.resolve_name(span.text)
+            if char:
+                sent_chars.add(char)
+                resolver.update_context(char)
+                if mention_log is not None:
+                    mention_log.add(span.start, sentence_index, ids[char])
 
         for char in dialogue_interactions:
             sent_chars.add(char)
 
         if len(sent_chars) > 1:
             chars = list(sent_chars)
+            n_pairs = len(chars) * (len(chars) - 1) // 2
+            if timeline is not None:
+                pair_chapters.extend([timeline.chapter_of(sent.start_char)] * n_pairs)
             for i in range(len(chars)):
                 for j in range(i + 1, len(chars)):
                     weight = 1.0 if (chars[i] in dialogue_interactions and
                                      chars[j] in dialogue_interactions) else 0.5
 
-                    interactions[chars[i]][chars[j]] += weight
-                    interactions[chars[j]][chars[i]] += weight
+                    rows.append(ids[chars[i]])
+                    cols.append(ids[chars[j]])
+                    pair_weights.append(weight)
 
         current_section_chars.update(sent_chars)
 
+    resolver.in_dialogue = in_dialogue
+    resolver.dialogue_started = in_dialogue
+    interactions.add_pairs(rows, cols, pair_weights)
+    if mention_log is not None:
+        mention_log.end_document(len(doc), n_sentences)
+    if timeline is not None:
+        timeline.add(pair_chapters, rows, cols, pair_weights)
+        timeline.end_document()
     return interactions
 
 
-def process_book(file_path, resolver):
+DEFAULT_CHUNK_SIZE = 100000
+# Версия нарезки на куски: входит в ключ кэша разметки, разметка старых кусков не подходит.
+CHUNK_FORMAT = 2
+
+
+def read_book(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def iter_chunks(file_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Книга читается построчно и отдаётся кусками примерно по chunk_size символов: в памяти
+    # держится один кусок, а не весь текст. Кусок режется только перед строкой, которая
+    # начинается не с пробельного символа, и края не обрезаются - тогда пробельные токены
+    # spaCy на стыке те же, что и при разборе книги целиком, и позиции в MentionLog не сдвигаются.
+    buffer = []
+    size = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if size >= chunk_size and line[:1] and not line[:1].isspace():
+                yield ''.join(buffer)
+                buffer = []
+                size = 0
+            buffer.append(line)
+            size += len(line)
+    chunk = ''.join(buffer)
+    if chunk:
+        yield chunk
+
+
+def book_chunk_size(file_path, chunk_size):
+    # Книги длиннее MAX_LENGTH целиком не разбираются, для них потоковый режим включается сам.
+    if chunk_size is None and os.path.getsize(file_path) > MAX_LENGTH:
+        return DEFAULT_CHUNK_SIZE
+    return chunk_size
+
+
+def book_texts(book_files, chunk_size=None, failed=None):
+    # Книга, которую не удалось прочитать, пропускается и попадает в failed: её уже
+    # отданные куски не должны считаться полным результатом книги.
+    for file_path in book_files:
+        try:
+            size = book_chunk_size(file_path, chunk_size)
+            if size:
+                for chunk in iter_chunks(file_path, size):
+                    yield chunk, file_path
+            else:
+                yield read_book(file_path), file_path
+        except Exception as e:
+            print(f"Ошибка при обработке {file_path}: {str(e)}")
+            if failed is not None:
+                failed.add(file_path)
+
+
+# Для analyze_interactions достаточно текста токенов, границ предложений и сущностей.
+ANNOTATION_ATTRS = ["ORTH", "SENT_START", "ENT_IOB", "ENT_TYPE"]
+
+
+def hash_file(file_path):
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h
+
+
+class AnnotationCache:
+    # Разметка книги сохраняется в DocBin, чтобы подбор порогов normalize_relations и правка
+    # characters.txt не требовали повторного разбора spaCy. Ключ - хэш содержимого файла,
+    # версия модели и размер кусков потокового режима.
+    def __init__(self, pipeline, cache_dir="cache/annotations"):
+        self.pipeline = pipeline
+        self.cache_dir = cache_dir
+
+    def key(self, file_path, chunk_size):
+        h = hash_file(file_path)
+        meta = self.pipeline.meta
+        model = f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}|{','.join(self.pipeline.pipe_names)}"
+        h.update(f"{model}|spacy-{spacy.__version__}|{chunk_size}|chunks-{CHUNK_FORMAT}".encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, file_path, chunk_size):
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        return os.path.join(self.cache_dir, f"{name}-{self.key(file_path, chunk_size)[:16]}.spacy")
+
+    def load(self, path):
+        if not os.path.exists(path):
+            return None
+        return DocBin().from_disk(path).get_docs(self.pipeline.vocab)
+
+    def new_bin(self):
+        return DocBin(attrs=ANNOTATION_ATTRS)
+
+    def save(self, path, doc_bin):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp'
+        doc_bin.to_disk(tmp_path)
+        os.replace(tmp_path, path)
+
+
+# Версия логики извлечения связей: увеличивается при изменениях, влияющих на сырые веса,
+# чтобы инкрементальный режим не смешивал старые частичные результаты с новыми.
+PIPELINE_VERSION = 4
+
+
+class PartialStore:
+    # Сырые (ненормализованные) веса каждой книги хранятся в отдельном .npz, а manifest.json
+    # связывает книгу с хэшем её содержимого. Подпись манифеста - версия кода, хэш списка
+    # персонажей и параметры разбора; при её смене все частичные результаты устаревают.
+    def __init__(self, signature, cache_dir="cache/partials"):
+        self.cache_dir = cache_dir
+        self.signature = signature
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        self.books = {}
+        self.hashes = {}
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('signature') == signature:
+                self.books = manifest.get('books', {})
+        except (OSError, ValueError):
+            pass
+
+    def book_hash(self, file_path):
+        if file_path not in self.hashes:
+            self.hashes[file_path] = hash_file(file_path).hexdigest()
+        return self.hashes[file_path]
+
+    def pending(self, book_files):
+        pending = []
+        for file_path in book_files:
+            entry = self.books.get(file_path)
+            if (entry is None or entry['hash'] != self.book_hash(file_path)
+                    or not os.path.exists(os.path.join(self.cache_dir, entry['partial']))):
+                pending.append(file_path)
+        return pending
+
+    def save(self, file_path, interactions, book_windows=None, timeline=None):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        book_hash = self.book_hash(file_path)
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        partial = f"{name}-{book_hash[:16]}.npz"
+        arrays = {}
+        networks = {'relations': interactions}
+        for window, network in (book_windows or {}).items():
+            networks[f"window_{window}"] = network
+        for key, network in networks.items():
+            rows, cols = np.nonzero(network.weights)
+            arrays[f"{key}_rows"] = rows.astype(np.int32)
+            arrays[f"{key}_cols"] = cols.astype(np.int32)
+            arrays[f"{key}_weights"] = network.weights[rows, cols]
+        if timeline is not None:
+            chapter_ids, rows, cols, weights = timeline.deltas()
+            arrays.update(chapters_ids=chapter_ids, chapters_rows=rows, chapters_cols=cols,
+                          chapters_weights=weights, chapters_titles=np.array(timeline.titles, dtype=str))
+        tmp_path = os.path.join(self.cache_dir, partial + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, os.path.join(self.cache_dir, partial))
+
+        previous = self.books.get(file_path)
+        self.books[file_path] = {'hash': book_hash, 'partial': partial}
+        self.write_manifest()
+        if previous and previous['partial'] != partial:
+            self.remove_partial(previous['partial'])
+
+    def load(self, file_path, names, windows=()):
+        path = os.path.join(self.cache_dir, self.books[file_path]['partial'])
+        with np.load(path) as data:
+            def matrix(key):
+                network = CooccurrenceMatrix(names)
+                rows, cols = data[f"{key}_rows"], data[f"{key}_cols"]
+                network.weights[rows, cols] = data[f"{key}_weights"]
+                return network
+            timeline = None
+            if 'chapters_ids' in data:
+                timeline = ChapterTimeline.from_deltas(
+                    data['chapters_titles'].tolist(), data['chapters_ids'], data['chapters_rows'],
+                    data['chapters_cols'], data['chapters_weights'])
+            return matrix('relations'), {window: matrix(f"window_{window}") for window in windows}, timeline
+
+    def merge(self, book_files, names, windows=(), chapters=None):
+        # Записи книг, изменившихся с прошлого запуска и не обработанных сейчас (ошибка
+        # разбора), не подходят: их веса относятся к старому тексту.
+        relations = CooccurrenceMatrix(names)
+        window_networks = {window: CooccurrenceMatrix(names) for window in windows}
+        for file_path in book_files:
+            if file_path not in self.books:
+                print(f"Нет результатов для {file_path}, книга не вошла в сеть")
+                continue
+            if self.books[file_path]['hash'] != self.book_hash(file_path):
+                print(f"Результаты {file_path} устарели, книга не вошла в сеть")
+                continue
+            book_relations, book_windows, timeline = self.load(file_path, names, windows)
+            relations += book_relations
+            for window, network in book_windows.items():
+                window_networks[window] += network
+            if chapters is not None and timeline is not None:
+                chapters.books[file_path] = timeline
+        return relations, window_networks
+
+    def prune(self, book_files):
+        # Записи удалённых книг и файлы, на которые манифест больше не ссылается.
+        kept = set(book_files)
+        self.books = {path: entry for path, entry in self.books.items() if path in kept}
+        self.write_manifest()
+        referenced = {entry['partial'] for entry in self.books.values()}
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz') and name not in referenced:
+                self.remove_partial(name)
+
+    def remove_partial(self, name):
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def write_manifest(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'signature': self.signature, 'books': self.books}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+
+def pipeline_signature(resolver, mentions, chunk_size, windowed, chapters=None):
+    names_hash = hashlib.sha256('\n'.join(resolver.index.names).encode('utf-8')).hexdigest()
+    # Падежная нормализация (pymorphy3 или стемминг) меняет разрешение имён и сырые веса.
+    normalizer = f"pymorphy3-{getattr(pymorphy3, '__version__', '')}" if pymorphy3 else "stem"
+    return {
+        'version': PIPELINE_VERSION,
+        'characters': names_hash,
+        'normalizer': normalizer,
+        'mentions': mentions,
+        'chunk_size': chunk_size,
+        'windows': list(windowed.windows) if windowed else None,
+        'window_unit': windowed.unit if windowed else None,
+        'window_decay': windowed.decay_name if windowed else None,
+        'chapters': chapters is not None,
+    }
+
+
+def process_book(file_path, resolver, chunk_size=None, cache=None, engine=None, windowed=None,
+                 chapters=None):
+    # Состояние диалога и context_window резолвера переходят через границы кусков,
+    # поэтому потоковый разбор даёт те же связи, что и разбор книги одним Doc.
+    # Возвращает (файл, матрица книги, сети окон книги); при ошибке матрица - None.
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-            print(f"Анализ {os.path.basename(file_path)}...")
-            doc = nlp(text)
-            return analyze_interactions(doc, resolver)
+        print(f"Анализ {os.path.basename(file_path)}...")
+        engine = engine or NerMentions()
+        resolver = resolver.for_document()
+        size = book_chunk_size(file_path, chunk_size)
+        cache_path = cache.path(file_path, size) if cache else None
+        docs = cache.load(cache_path) if cache else None
+        doc_bin = None
+        failed = set()
+        if docs is None:
+            docs = (engine.nlp(text) for text, _ in book_texts([file_path], size, failed))
+            doc_bin = cache.new_bin() if cache else None
+
+        interactions = CooccurrenceMatrix(resolver.index.names)
+        mention_log = MentionLog() if windowed else None
+        timeline = chapters.book(file_path) if chapters else None
+        for doc in docs:
+            if doc_bin is not None:
+                doc_bin.add(doc)
+            analyze_interactions(doc, resolver, engine, interactions, mention_log, timeline)
+        if failed:
+            if chapters:
+                chapters.books.pop(file_path, None)
+            return file_path, None, None
+        if doc_bin is not None:
+            cache.save(cache_path, doc_bin)
+        book_windows = windowed.add_book(mention_log) if windowed else None
+        return file_path, interactions, book_windows
     except Exception as e:
         print(f"Ошибка при обработке {file_path}: {str(e)}")
-        return defaultdict(Counter)
+        if chapters:
+            chapters.books.pop(file_path, None)
+        return file_path, None, None
 
 
-def normalize_relations(relations, min_links=3, min_weight=2.0):
+def process_books_parallel(book_files, resolver, n_process=4, batch_size=1,
+                           chunk_size=None, cache=None, engine=None, windowed=None, chapters=None):
+    # Разбор spaCy упирается в CPU и GIL, поэтому книги (или их куски) раздаются процессам
+    # через nlp.pipe. Документы возвращаются в исходном порядке, а состояние резолвера
+    # сбрасывается перед каждой книгой, так что результат совпадает с последовательным запуском.
+    # Книги с готовой разметкой в кэше разбираются без spaCy.
+    engine = engine or NerMentions()
+    pending = []
+    cache_paths = {}
+    for file_path in book_files:
+        if cache is None:
+            pending.append(file_path)
+            continue
+        cache_paths[file_path] = cache.path(file_path, book_chunk_size(file_path, chunk_size))
+        docs = cache.load(cache_paths[file_path])
+        if docs is None:
+            pending.append(file_path)
+            continue
+        print(f"Анализ {os.path.basename(file_path)} (из кэша разметки)...")
+        book_resolver = resolver.for_document()
+        interactions = CooccurrenceMatrix(resolver.index.names)
+        mention_log = MentionLog() if windowed else None
+        timeline = chapters.book(file_path) if chapters else None
+        for doc in docs:
+            analyze_interactions(doc, book_resolver, engine, interactions, mention_log, timeline)
+        yield file_path, interactions, windowed.add_book(mention_log) if windowed else None
 
-    filtered = defaultdict(Counter)
-    for char, links in relations.items():
-        for other, weight in links.items():
-            if weight >= min_weight:
-                filtered[char][other] = weight
+    def finish(file_path):
+        # К моменту смены книги генератор текстов уже дочитал (или не смог дочитать) её.
+        if file_path in failed:
+            if chapters:
+                chapters.books.pop(file_path, None)
+            return file_path, None, None
+        if doc_bin is not None:
+            cache.save(cache_paths[file_path], doc_bin)
+        return file_path, interactions, windowed.add_book(mention_log) if windowed else None
 
-    strong_chars = {char for char in filtered
-                    if sum(filtered[char].values()) >= min_links}
+    current = None
+    interactions = None
+    doc_bin = None
+    mention_log = None
+    failed = set()
+    for doc, file_path in engine.nlp.pipe(book_texts(pending, chunk_size, failed), as_tuples=True,
+                                          n_process=n_process, batch_size=batch_size):
+        if file_path != current:
+            if current is not None:
+                yield finish(current)
+            print(f"Анализ {os.path.basename(file_path)}...")
+            book_resolver = resolver.for_document()
+            current = file_path
+            interactions = CooccurrenceMatrix(resolver.index.names)
+            doc_bin = cache.new_bin() if cache else None
+            mention_log = MentionLog() if windowed else None
+            timeline = chapters.book(file_path) if chapters else None
+        if doc_bin is not None:
+            doc_bin.add(doc)
+        analyze_interactions(doc, book_resolver, engine, interactions, mention_log, timeline)
+    if current is not None:
+        yield finish(current)
 
-    final_relations = {
-        char: {other: weight for other, weight in links.items()
-               if other in strong_chars}
-        for char, links in filtered.items()
-        if char in strong_chars
-    }
 
-    return final_relations
+def benchmark_mentions(book_files, resolver, chunk_size=DEFAULT_CHUNK_SIZE):
+    # Скорость считается вместе с разбором spaCy, полнота - по упоминаниям, которые
+    # пересекаются по тексту и разрешаются в одного и того же персонажа.
+    found = {}
+    for name, engine_cls in MENTION_ENGINES.items():
+        engine = engine_cls(resolver.index)
+        mentions = defaultdict(list)
+        chars = 0
+        start = time.perf_counter()
+        for file_path in book_files:
+            for chunk_id, (text, _) in enumerate(book_texts([file_path], chunk_size)):
+                doc = engine.nlp(text)
+                chars += len(text)
+                for span in engine.spans(doc):
+                    char = resolver.index.resolve(span.text)
+                    if char:
+                        mentions[(file_path, chunk_id, char)].append((span.start_char, span.end_char))
+        elapsed = time.perf_counter() - start
+        found[name] = mentions
+        total = sum(len(spans) for spans in mentions.values())
+        print(f"{name}: {chars / max(elapsed, 1e-9):,.0f} символов/с, упоминаний {total}")
+
+    def matched(reference, candidate):
+        hits = 0
+        for key, spans in reference.items():
+            others = candidate.get(key, [])
+            hits += sum(1 for s, e in spans if any(s < oe and os_ < e for os_, oe in others))
+        return hits
+
+    ner_total = sum(len(spans) for spans in found['ner'].values())
+    matcher_total = sum(len(spans) for spans in found['matcher'].values())
+    if ner_total:
+        print(f"Полнота matcher относительно NER: {matched(found['ner'], found['matcher']) / ner_total:.1%}")
+    if matcher_total:
+        print(f"Доля упоминаний matcher, найденных и NER: "
+              f"{matched(found['matcher'], found['ner']) / matcher_total:.1%}")
+    return found
+
+
+def normalize_relations(relations, min_links=3, min_weight=2.0):
+    if not isinstance(relations, CooccurrenceMatrix):
+        relations = CooccurrenceMatrix.from_relations(relations)
+
+    filtered = np.where(relations.weights >= min_weight, relations.weights, 0.0)
+    strong = (filtered > 0).any(axis=1) & (filtered.sum(axis=1) >= min_links)
+    return CooccurrenceMatrix(relations.names, filtered).subset(strong)
 
 
 def save_network(relations, output_file):
+    if isinstance(relations, CooccurrenceMatrix):
+        relations = relations.to_relations()
     if not relations:
         print("Нет данных для сохранения. Проверьте входные файлы.")
         return
 
     formatted = {
-        ' '.join(word.capitalize() for word in k.split()): {
-            ' '.join(word.capitalize() for word in vk.split()): round(vv, 1)
+        display_name(k): {
+            display_name(vk): round(vv, 1)
             for vk, vv in v.items()
         }
         for k, v in relations.items()
@@ -175,10 +927,13 @@ def save_network(relations, output_file):
 
     with open(output_file, 'w', encoding='utf-8') as f:
         json.dump(formatted, f, indent=2, ensure_ascii=False)
+    write_store(binary_path(output_file), network=formatted)
     print(f"Сохранено в {output_file}")
 
 
-def main():
+def main(n_process=4, batch_size=1, chunk_size=None, use_cache=True, n_threads=1,
+         mentions='ner', benchmark=False, windows=None, window_unit='tokens', window_decay='linear',
+         incremental=False, chapters=None, chapter_window=3):
     if not os.path.exists("characters.txt"):
         print("Создайте файл characters.txt со списком персонажей!")
         return
@@ -187,25 +942,109 @@ def main():
         print("Создайте папку books с текстами в формате .txt!")
         return
 
-    book_files = [os.path.join("books", f) for f in os.listdir("books") if f.endswith('.txt')]
+    book_files = sorted(os.path.join("books", f) for f in os.listdir("books") if f.endswith('.txt'))
     if not book_files:
         print("Добавьте файлы книг в папку books!")
         return
 
     resolver = CharacterResolver("characters.txt")
-    all_relations = defaultdict(Counter)
+    if benchmark:
+        benchmark_mentions(book_files, resolver, chunk_size or DEFAULT_CHUNK_SIZE)
+        return
+
+    engine = MENTION_ENGINES[mentions](resolver.index)
+    cache = AnnotationCache(engine.nlp) if use_cache else None
+    all_relations = CooccurrenceMatrix(resolver.index.names)
+    windowed = None
+    if windows:
+        windowed = WindowedCooccurrence(resolver.index.names, windows, window_unit, window_decay)
+    timelines = None
+    if chapters:
+        timelines = SeriesTimeline(resolver.index.names, chapters, chapter_window)
+
+    partials = None
+    pending = book_files
+    if incremental:
+        partials = PartialStore(pipeline_signature(resolver, mentions, chunk_size, windowed, timelines))
+        pending = partials.pending(book_files)
+        print(f"Книг без изменений: {len(book_files) - len(pending)}, к обработке: {len(pending)}")
+
+    def book_results():
+        if n_process > 1:
+            yield from process_books_parallel(pending, resolver, n_process, batch_size,
+                                              chunk_size, cache, engine, windowed, timelines)
+            return
+        # Каждая книга получает собственное состояние резолвера, а результаты сливаются
+        # в порядке book_files, поэтому число потоков не влияет на итоговые веса.
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            yield from executor.map(
+                lambda f: process_book(f, resolver, chunk_size, cache, engine, windowed, timelines), pending)
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(process_book, f, resolver) for f in book_files]
-        for future in futures:
-            book_relations = future.result()
-            for char, links in book_relations.items():
-                for other, weight in links.items():
-                    all_relations[char][other] += weight
+    for file_path, book_relations, book_windows in book_results():
+        if book_relations is None:
+            continue
+        if partials:
+            partials.save(file_path, book_relations, book_windows,
+                          timelines.books.get(file_path) if timelines else None)
+        else:
+            all_relations += book_relations
+
+    window_networks = windowed.networks if windowed else {}
+    if partials:
+        partials.prune(book_files)
+        all_relations, window_networks = partials.merge(
+            book_files, resolver.index.names, windowed.windows if windowed else (), timelines)
+
+    stats = resolver.index.resolve_stats()
+    print(f"Разрешено имён: {stats['resolved']} из {stats['lookups']} ({stats['resolve_hit_rate']:.1%}), "
+          f"через падежную нормализацию: {stats['resolved_by_normalization']}, "
+          f"попаданий в кэш нормализации: {stats['cache_hit_rate']:.1%}")
 
     final_relations = normalize_relations(all_relations)
     save_network(final_relations, "precise_character_network.json")
 
+    if windowed:
+        for window, network in window_networks.items():
+            save_network(normalize_relations(network),
+                         f"precise_character_network_{windowed.name(window)}.json")
+
+    if timelines:
+        timelines.save("precise_character_network_chapters.json", book_files)
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Построение сети персонажей по текстам книг")
+    parser.add_argument("--processes", type=int, default=4,
+                        help="число процессов spaCy (1 - разбор в потоках текущего процесса)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="число потоков при --processes 1")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="число книг (или кусков) в одном пакете nlp.pipe")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="потоковый разбор кусками примерно по N символов")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="не использовать кэш разметки книг (cache/annotations)")
+    parser.add_argument("--mentions", choices=sorted(MENTION_ENGINES), default="ner",
+                        help="поиск упоминаний: ner - модель NER, matcher - PhraseMatcher по characters.txt")
+    parser.add_argument("--benchmark-mentions", action="store_true",
+                        help="сравнить полноту и скорость ner и matcher и выйти")
+    parser.add_argument("--windows", type=lambda value: [int(w) for w in value.split(',')], default=None,
+                        help="дополнительно построить сети по окнам совместных упоминаний, например 10,50")
+    parser.add_argument("--window-unit", choices=["tokens", "sentences"], default="tokens",
+                        help="в чём измеряется окно")
+    parser.add_argument("--window-decay", choices=sorted(WINDOW_DECAYS), default="linear",
+                        help="убывание веса связи с расстоянием между упоминаниями")
+    parser.add_argument("--chapters", choices=TIMELINE_MODES, default=None,
+                        help="дополнительно сохранить сети по главам: cumulative - накопленные, "
+                             "sliding - по скользящему окну глав")
+    parser.add_argument("--chapter-window", type=int, default=3,
+                        help="ширина скользящего окна в главах для --chapters sliding")
+    parser.add_argument("--incremental", action="store_true",
+                        help="обрабатывать только новые и изменённые книги, сырые веса книг "
+                             "хранить в cache/partials")
+    args = parser.parse_args()
+    main(n_process=args.processes, batch_size=args.batch_size, chunk_size=args.chunk_size,
+         use_cache=not args.no_cache, n_threads=args.threads,
+         mentions=args.mentions, benchmark=args.benchmark_mentions,
+         windows=args.windows, window_unit=args.window_unit, window_decay=args.window_decay,
+         incremental=args.incremental, chapters=args.chapters, chapter_window=args.chapter_window)
@@ -0,0 +1,259 @@
+import os
+import json
+import hashlib
+import numpy as np
+import networkx as nx
+
+
+class LayoutCache:
+    def __init__(self, cache_dir, max_entries=20):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+    def key(self, G, params):
+        h = hashlib.sha256()
+        for node in sorted(map(str, G.nodes())):
+            h.update(node.encode('utf-8'))
+            h.update(b'\0')
+        edges = sorted(
+            (min(str(u), str(v)), max(str(u), str(v)), repr(float(data.get('weight', 1.0))))
+            for u, v, data in G.edges(data=True)
+        )
+        for u, v, weight in edges:
+            h.update(f"{u}\t{v}\t{weight}\n".encode('utf-8'))
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def load(self, key):
+        try:
+            with open(self.path(key), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        os.utime(self.path(key))
+        return {node: self.decode(value) for node, value in data.items()}
+
+    def encode(self, xy):
+        return [float(xy[0]), float(xy[1])]
+
+    def decode(self, value):
+        return np.array(value)
+
+    def save(self, key, pos):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.path(key) + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({node: self.encode(value) for node, value in pos.items()},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, self.path(key))
+        self.prune()
+
+    def entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                 if name.endswith('.json')]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def latest(self, nodes=None):
+        # Самая свежая раскладка; если заданы узлы - та, в которой их больше всего
+        # (при равенстве - более свежая), чтобы не стартовать с раскладки другого графа.
+        best, best_overlap = None, -1
+        nodes = set(nodes) if nodes is not None else None
+        for path in self.entries():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if nodes is None:
+                return {node: self.decode(value) for node, value in data.items()}
+            overlap = len(nodes.intersection(data))
+            if overlap > best_overlap:
+                best, best_overlap = data, overlap
+        if best_overlap <= 0:
+            return None
+        return {node: self.decode(value) for node, value in best.items()}
+
+    def prune(self):
+        for path in self.entries()[self.max_entries:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def spring_layout(G, k=0.5, iterations=50, seed=42, pos=None):
+    return nx.spring_layout(G, k=k, iterations=iterations, seed=seed, pos=pos)
+
+
+def _repulsion(coords, k, leaf_size, max_depth=10):
+    # Квадродерево строится как набор вложенных сеток 2^L x 2^L. На каждом уровне
+    # узел взаимодействует с центрами масс "хорошо разделённых" клеток (дети соседей
+    # родительской клетки, не соседние с его собственной), на последнем уровне -
+    # напрямую с узлами из соседних клеток. Так каждая пара учитывается ровно один раз.
+    n = len(coords)
+    lower = coords.min(axis=0)
+    span = max(float((coords.max(axis=0) - lower).max()), 1e-9) * (1 + 1e-9)
+    unit = (coords - lower) / span
+    depth = max(1, int(np.ceil(np.log(max(n / leaf_size, 1)) / np.log(4))))
+    # При сильной кластеризации углубляем дерево, чтобы ближнее поле не выродилось в O(n^2).
+    while depth < max_depth:
+        size = 2 ** depth
+        cell = np.minimum((unit * size).astype(np.int64), size - 1)
+        counts = np.bincount(cell[:, 0] * size + cell[:, 1])
+        if (counts.astype(float) ** 2).sum() <= 2 * leaf_size * n:
+            break
+        depth += 1
+    displacement = np.zeros_like(coords)
+
+    near = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    children = np.array([(2 * dx + a, 2 * dy + b)
+                         for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                         for a in (0, 1) for b in (0, 1)])
+
+    for level in range(1, depth + 1):
+        size = 2 ** level
+        cell = np.minimum((unit * size).astype(np.int64), size - 1)
+        keys = cell[:, 0] * size + cell[:, 1]
+        cell_keys, inverse = np.unique(keys, return_inverse=True)
+        lookup = np.full(size * size, -1, dtype=np.int64)
+        lookup[cell_keys] = np.arange(len(cell_keys))
+        mass = np.bincount(inverse, minlength=len(cell_keys)).astype(float)
+        center = np.stack([
+            np.bincount(inverse, weights=coords[:, 0], minlength=len(cell_keys)),
+            np.bincount(inverse, weights=coords[:, 1], minlength=len(cell_keys)),
+        ], axis=1) / mass[:, None]
+
+        if level > 1:
+            parent = cell // 2
+            cx = 2 * parent[:, 0, None] + children[None, :, 0]
+            cy = 2 * parent[:, 1, None] + children[None, :, 1]
+            valid = ((cx >= 0) & (cx < size) & (cy >= 0) & (cy < size) &
+                     ((np.abs(cx - cell[:, 0, None]) > 1) | (np.abs(cy - cell[:, 1, None]) > 1)))
+            rows, cols = np.nonzero(valid)
+            other = lookup[cx[rows, cols] * size + cy[rows, cols]]
+            occupied = other >= 0
+            rows, other = rows[occupied], other[occupied]
+            delta = coords[rows] - center[other]
+            distance2 = np.maximum((delta ** 2).sum(axis=1), 1e-4)
+            force = delta * (mass[other] * k * k / distance2)[:, None]
+            displacement[:, 0] += np.bincount(rows, weights=force[:, 0], minlength=n)
+            displacement[:, 1] += np.bincount(rows, weights=force[:, 1], minlength=n)
+
+        if level == depth:
+            order = np.argsort(keys, kind='stable')
+            starts = np.searchsorted(keys[order], cell_keys)
+            counts = mass.astype(np.int64)
+            nx_ = cell[:, 0, None] + near[None, :, 0]
+            ny_ = cell[:, 1, None] + near[None, :, 1]
+            valid = (nx_ >= 0) & (nx_ < size) & (ny_ >= 0) & (ny_ < size)
+            rows, cols = np.nonzero(valid)
+            other = lookup[nx_[rows, cols] * size + ny_[rows, cols]]
+            occupied = other >= 0
+            rows, other = rows[occupied], other[occupied]
+            repeat = counts[other]
+            first = np.repeat(starts[other], repeat)
+            offset = np.arange(repeat.sum()) - np.repeat(np.cumsum(repeat) - repeat, repeat)
+            i = np.repeat(rows, repeat)
+            j = order[first + offset]
+            keep = i != j
+            i, j = i[keep], j[keep]
+            delta = coords[i] - coords[j]
+            distance2 = np.maximum((delta ** 2).sum(axis=1), 1e-4)
+            force = delta * (k * k / distance2)[:, None]
+            displacement[:, 0] += np.bincount(i, weights=force[:, 0], minlength=n)
+            displacement[:, 1] += np.bincount(i, weights=force[:, 1], minlength=n)
+
+    return displacement
+
+
+def barnes_hut_layout(G, k=None, iterations=100, seed=42, pos=None,
+                      leaf_size=8, threshold=1e-4, weight='weight', temperature=0.1):
+    # Силовая раскладка Фрухтермана-Рейнгольда (как в nx.spring_layout), но отталкивание
+    # считается по квадродереву за O(n log n) вместо попарных O(n^2).
+    # temperature - начальный шаг в долях размера раскладки; малое значение при заданном pos
+    # лишь подправляет готовую картинку.
+    nodes = list(G.nodes())
+    n = len(nodes)
+    if n == 0:
+        return {}
+    if n == 1:
+        return {nodes[0]: np.zeros(2)}
+
+    index = {node: i for i, node in enumerate(nodes)}
+    rng = np.random.default_rng(seed)
+    coords = rng.random((n, 2))
+    if pos:
+        known = np.array([index[node] for node in pos if node in index], dtype=np.int64)
+        if len(known):
+            placed = np.array([pos[nodes[i]] for i in known], dtype=float)
+            lower, upper = placed.min(axis=0), placed.max(axis=0)
+            coords = lower + coords * np.maximum(upper - lower, 1e-9)
+            coords[known] = placed
+
+    edges = [(index[u], index[v], float(data.get(weight, 1.0)))
+             for u, v, data in G.edges(data=True) if u != v]
+    src = np.array([e[0] for e in edges], dtype=np.int64)
+    dst = np.array([e[1] for e in edges], dtype=np.int64)
+    edge_weight = np.array([e[2] for e in edges], dtype=float)
+
+    if k is None:
+        k = np.sqrt(1.0 / n)
+    t = max(float((coords.max(axis=0) - coords.min(axis=0)).max()), 1e-9) * temperature
+    dt = t / (iterations + 1)
+
+    for _ in range(iterations):
+        displacement = _repulsion(coords, k, leaf_size)
+        if len(edges):
+            delta = coords[src] - coords[dst]
+            distance = np.maximum(np.sqrt((delta ** 2).sum(axis=1)), 0.01)
+            force = delta * (edge_weight * distance / k)[:, None]
+            for axis in (0, 1):
+                displacement[:, axis] -= np.bincount(src, weights=force[:, axis], minlength=n)
+                displacement[:, axis] += np.bincount(dst, weights=force[:, axis], minlength=n)
+
+        length = np.sqrt((displacement ** 2).sum(axis=1))
+        length = np.where(length < 0.01, 0.1, length)
+        delta_pos = displacement * (t / length)[:, None]
+        coords += delta_pos
+        t -= dt
+        if np.linalg.norm(delta_pos) / n < threshold:
+            break
+
+    coords = nx.rescale_layout(coords)
+    return dict(zip(nodes, coords))
+
+
+LAYOUT_ENGINES = {
+    'spring': spring_layout,
+    'barnes_hut': barnes_hut_layout,
+}
+
+
+def get_layout_engine(name, G, auto_threshold=500):
+    if name == 'auto':
+        name = 'barnes_hut' if G.number_of_nodes() > auto_threshold else 'spring'
+    return LAYOUT_ENGINES[name]
+
+
+def cached_layout(G, cache, layout_func=spring_layout, **params):
+    # Неизменённый граф берётся из кэша целиком; для изменённого раскладка
+    # стартует с последних сохранённых координат, чтобы картинка не "прыгала".
+    key = cache.key(G, dict(params, layout=layout_func.__name__))
+    pos = cache.load(key)
+    if pos is not None and all(node in pos for node in G.nodes()):
+        return pos
+
+    previous = cache.latest(G.nodes())
+    warm_start = None
+    if previous:
+        warm_start = {node: previous[node] for node in G.nodes() if node in previous}
+        if len(warm_start) >= 0.9 * G.number_of_nodes() and 'iterations' in params:
+            params = dict(params, iterations=max(5, params['iterations'] // 5))
+    pos = layout_func(G, pos=warm_start or None, **params)
+    cache.save(key, pos)
+    return pos
@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from graph_store import load_data, open_store
+from episode_main import build_adjacency
+
+ATTRIBUTE_INDEXES = ('faculty', 'side', 'role', 'blood_status', 'species')
+ALL_PAIRS_LIMIT = 2000
+
+
+class QueryError(Exception):
+    pass
+
+
+def file_mtimes(*paths):
+    return tuple(os.path.getmtime(path) for path in paths)
+
+
+class GraphIndex:
+    # Обе таблицы загружаются один раз и превращаются в индексы: смежность в CSR с соседями,
+    # отсортированными по убыванию веса, множества персонажей по значениям атрибутов и
+    # кратчайшие пути (для небольших сетей - все пары сразу, иначе деревья от запрошенных
+    # источников в LRU-кэше). Кратчайший путь идёт по сильным связям: длина ребра = 1 / вес.
+    # Ответы с подграфом содержат network и characters в формате исходных JSON-файлов,
+    # поэтому их можно сразу передать в HPNetworkVisualizer.create_graph.
+    # После построения индекс не меняется (кроме LRU путей под своей блокировкой), поэтому
+    # его читают потоки сервера без блокировок; при перезагрузке строится новый объект.
+    def __init__(self, network_path, character_path, path_cache_size=256):
+        self.path_cache_size = path_cache_size
+        self.path_lock = threading.Lock()
+        # Время изменения берётся до чтения: правка файла во время загрузки вызовет повторную.
+        self.loaded_mtimes = file_mtimes(network_path, character_path)
+        network = open_store(network_path)
+        if network is None:
+            network = load_data(network_path)
+        self.characters = load_data(character_path)
+
+        # Та же симметричная матрица, что и для ролей: вес пары - максимум из двух направлений.
+        names, matrix = build_adjacency(network)
+        names = list(names)
+        n = len(names)
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.lower_ids = {name.lower(): i for i, name in enumerate(names)}
+        self.matrix = matrix
+        self.layout = None
+
+        order = np.lexsort((matrix.indices, -matrix.data,
+                            np.repeat(np.arange(n), np.diff(matrix.indptr))))
+        self.indptr = matrix.indptr
+        self.neighbors = matrix.indices[order]
+        self.weights = matrix.data[order]
+
+        self.attribute_index = {}
+        for attribute in ATTRIBUTE_INDEXES:
+            index = {}
+            for name in names:
+                value = self.characters.get(name, {}).get(attribute)
+                if value is not None:
+                    index.setdefault(value, []).append(self.ids[name])
+            self.attribute_index[attribute] = {value: np.array(ids) for value, ids in index.items()}
+
+        self.distances = self.matrix.copy()
+        self.distances.data = 1.0 / self.distances.data
+        self.all_pairs = None
+        if n <= ALL_PAIRS_LIMIT:
+            self.all_pairs = dijkstra(self.distances, directed=False, return_predecessors=True)
+        self.path_cache = OrderedDict()
+
+    def node(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.lower_ids.get(str(name).lower())
+        if i is None:
+            raise QueryError(f"Персонаж не найден: {name}")
+        return i
+
+    def adjacent(self, i):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.neighbors[start:end], self.weights[start:end]
+
+    def shortest_tree(self, source):
+        if self.all_pairs is not None:
+            distances, predecessors = self.all_pairs
+            return distances[source], predecessors[source]
+        with self.path_lock:
+            if source in self.path_cache:
+                self.path_cache.move_to_end(source)
+                return self.path_cache[source]
+        distances, predecessors = dijkstra(self.distances, directed=False, indices=source,
+                                           return_predecessors=True)
+        with self.path_lock:
+            self.path_cache[source] = (distances, predecessors)
+            while len(self.path_cache) > self.path_cache_size:
+                self.path_cache.popitem(last=False)
+        return distances, predecessors
+
+    def subgraph(self, ids, edges=None):
+        # Индуцированный подграф (или только заданные рёбра) в формате исходных файлов.
+        ids = sorted(set(int(i) for i in ids))
+        selected = set(ids)
+        network = {}
+        for i in ids:
+            neighbors, weights = self.adjacent(i)
+            links = {self.names[j]: float(w) for j, w in zip(neighbors.tolist(), weights.tolist())
+                     if j in selected and (edges is None or (min(i, j), max(i, j)) in edges)}
+            network[self.names[i]] = links
+        characters = {self.names[i]: self.characters[self.names[i]]
+                      for i in ids if self.names[i] in self.characters}
+        return {'network': network, 'characters': characters}
+
+    def top(self, name, k=10):
+        i = self.node(name)
+        neighbors, weights = self.adjacent(i)
+        neighbors, weights = neighbors[:k], weights[:k]
+        result = self.subgraph([i, *neighbors.tolist()],
+                               edges={(min(i, j), max(i, j)) for j in neighbors.tolist()})
+        result['ties'] = [{'name': self.names[j], 'weight': float(w)}
+                          for j, w in zip(neighbors.tolist(), weights.tolist())]
+        return result
+
+    def neighborhood(self, name, hops=1, min_weight=0.0, limit=None):
+        # Обход в ширину по CSR; limit ограничивает число соседей каждого узла сильнейшими.
+        start = self.node(name)
+        depth = {start: 0}
+        queue = deque([start])
+        while queue:
+            i = queue.popleft()
+            if depth[i] >= hops:
+                continue
+            neighbors, weights = self.adjacent(i)
+            keep = weights >= min_weight
+            neighbors = neighbors[keep][:limit] if limit else neighbors[keep]
+            for j in neighbors.tolist():
+                if j not in depth:
+                    depth[j] = depth[i] + 1
+                    queue.append(j)
+        result = self.subgraph(depth)
+        result['hops'] = {self.names[i]: d for i, d in depth.items()}
+        return result
+
+    def path(self, source, target):
+        i, j = self.node(source), self.node(target)
+        distances, predecessors = self.shortest_tree(i)
+        if not np.isfinite(distances[j]):
+            raise QueryError(f"Нет пути между {self.names[i]} и {self.names[j]}")
+        path = [j]
+        while path[-1] != i:
+            path.append(int(predecessors[path[-1]]))
+        path.reverse()
+        result = self.subgraph(path, edges={(min(a, b), max(a, b)) for a, b in zip(path, path[1:])})
+        result['path'] = [self.names[k] for k in path]
+        result['length'] = float(distances[j])
+        return result
+
+    def filter(self, **attributes):
+        # Как в batch_render: значение атрибута должно начинаться с одной из строк
+        # ("Гриффиндор" находит и "Гриффиндор (вероятно)"). Значения одного атрибута
+        # объединяются, разные атрибуты пересекаются.
+        selected = None
+        for attribute, values in attributes.items():
+            if attribute not in self.attribute_index:
+                raise QueryError(f"Нет индекса по атрибуту: {attribute}")
+            index = self.attribute_index[attribute]
+            if isinstance(values, str):
+                values = [values]
+            ids = np.concatenate([np.empty(0, dtype=int)] +
+                                 [ids for value, ids in index.items()
+                                  if any(str(value).startswith(wanted) for wanted in values)])
+            selected = ids if selected is None else np.intersect1d(selected, ids)
+        if selected is None:
+            selected = np.arange(len(self.names))
+        return self.subgraph(selected.tolist())
+
+
+class GraphService:
+    # Держит текущий GraphIndex и подменяет его одной ссылкой, когда файлы изменились:
+    # запрос берёт индекс один раз и до конца работает с согласованными массивами.
+    # Отрисовка HTML (общий HPNetworkVisualizer, его раскладка и файлы кэша раскладок)
+    # выполняется под отдельной блокировкой; раскладка полного графа считается один раз
+    # на индекс.
+    def __init__(self, network_path, character_path):
+        self.network_path = network_path
+        self.character_path = character_path
+        self.reload_lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.renderer = None
+        self.index = GraphIndex(network_path, character_path)
+
+    def current(self):
+        index = self.index
+        try:
+            if file_mtimes(self.network_path, self.character_path) == index.loaded_mtimes:
+                return index
+            with self.reload_lock:
+                if self.index is index:
+                    self.index = GraphIndex(self.network_path, self.character_path)
+                    print(f"Индексы перестроены (персонажей: {len(self.index.names)})")
+        except Exception as e:
+            # Файл мог быть записан не до конца: отвечаем по прежнему индексу.
+            print(f"Не удалось перезагрузить данные: {str(e)}")
+        return self.index
+
+    def get_renderer(self):
+        if self.renderer is None:
+            from app_graph import HPNetworkVisualizer
+            self.renderer = HPNetworkVisualizer(None)
+        return self.renderer
+
+    def render(self, index, result):
+        # Координаты берутся из раскладки полного графа (из кэша раскладок), поэтому
+        # персонажи стоят на тех же местах, что и в основном окне.
+        with self.render_lock:
+            renderer = self.get_renderer()
+            if index.layout is None:
+                full = renderer.create_graph(index.subgraph(range(len(index.names)))['network'])
+                index.layout = renderer.graph_layout(full)
+            G = renderer.create_graph(result['network'])
+            G.add_nodes_from(result['network'])
+            fig = renderer.build_figure(G, index.layout, result['characters'])
+            asset = renderer.plotly_asset(renderer.html_dir)
+            return fig.to_html(include_plotlyjs=f"/assets/{asset}")
+
+    def asset_path(self, name):
+        with self.render_lock:
+            if self.renderer is None:
+                return None
+            return os.path.join(self.renderer.html_dir, os.path.basename(name))
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # GET /top?name=...&k=10, /neighbors?name=...&hops=2&min_weight=0&limit=...,
+    # /path?source=...&target=..., /filter?faculty=...&side=...&role=...
+    # Параметр format=html возвращает готовую страницу с визуализацией подграфа.
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values for key, values in parse_qs(url.query).items()}
+        first = {key: values[0] for key, values in params.items()}
+        started = time.perf_counter()
+        try:
+            if url.path.startswith('/assets/'):
+                return self.send_asset(url.path[len('/assets/'):])
+            index = self.service.current()
+            if url.path == '/top':
+                result = index.top(first['name'], int(first.get('k', 10)))
+            elif url.path == '/neighbors':
+                result = index.neighborhood(
+                    first['name'], int(first.get('hops', 1)), float(first.get('min_weight', 0.0)),
+                    int(first['limit']) if 'limit' in first else None)
+            elif url.path == '/path':
+                result = index.path(first['source'], first['target'])
+            elif url.path == '/filter':
+                result = index.filter(**{key: values for key, values in params.items()
+                                         if key != 'format'})
+            else:
+                return self.send_json(404, {'error': f"Неизвестный запрос: {url.path}"})
+        except QueryError as e:
+            return self.send_json(404, {'error': str(e)})
+        except (KeyError, ValueError) as e:
+            return self.send_json(400, {'error': f"Некорректные параметры: {e}"})
+
+        result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 3)
+        if first.get('format') == 'html':
+            return self.send_html(index, result)
+        self.send_json(200, result)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_html(self, index, result):
+        body = self.service.render(index, result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_asset(self, name):
+        path = self.service.asset_path(name)
+        if path is None or not os.path.exists(path):
+            return self.send_json(404, {'error': f"Нет файла: {name}"})
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'max-age=86400')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    handler = type('BoundQueryHandler', (QueryHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Сервис запросов: http://{host}:{port}/ (персонажей: {len(service.index.names)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Локальный сервис запросов к сети персонажей")
+    parser.add_argument("--network", default=os.path.join(base_dir, "data", "precise_character_network.json"),
+                        help="Файл сети персонажей")
+    parser.add_argument("--characters", default=os.path.join(base_dir, "data", "character_info_with_roles.json"),
+                        help="Файл с информацией о персонажах")
+    parser.add_argument("--host", default="127.0.0.1", help="Адрес (по умолчанию только localhost)")
+    parser.add_argument("--port", type=int, default=8765, help="Порт")
+    args = parser.parse_args()
+
+    started = time.time()
+    service = GraphService(args.network, args.characters)
+    print(f"Индексы построены за {time.time() - started:.2f} с")
+    serve(service, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
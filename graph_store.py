@@ -0,0 +1,276 @@
+import os
+import json
+import argparse
+import numpy as np
+
+# Бинарный формат сети рядом с JSON: заголовок JSON с описанием секций, затем выровненные
+# массивы, которые читаются через numpy.memmap без разбора всего файла.
+#   names_blob/names_offsets   - интернированная таблица имён (UTF-8 + смещения);
+#   indptr/indices/weights     - CSR-матрица смежности, строки - первые `rows` имён
+#                                (ключи исходного JSON в его порядке);
+#   col_<i>_*                  - столбцы атрибутов узлов (строки как коды в таблицу значений).
+MAGIC = b"HPNET001"
+EXTENSION = ".hpnet"
+ALIGN = 8
+
+
+def binary_path(json_path):
+    return os.path.splitext(json_path)[0] + EXTENSION
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def is_network(data):
+    return all(isinstance(links, dict) and all(_is_number(w) for w in links.values())
+               for links in data.values())
+
+
+def _string_table(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _read_strings(blob, offsets):
+    data = blob.tobytes()
+    return [data[a:b].decode('utf-8') for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def _float32_exact(values):
+    # float32 хватает, если кратчайшая запись float32 читается обратно в то же число.
+    as32 = values.astype(np.float32)
+    return np.array_equal(as32.astype(str).astype(np.float64), values)
+
+
+def _restore_floats(values):
+    if values.dtype == np.float32:
+        return values.astype(str).astype(np.float64)
+    return np.asarray(values, dtype=np.float64)
+
+
+def _encode_column(values):
+    present = np.array([v is not None for v in values], dtype=np.uint8)
+    given = [v for v in values if v is not None]
+    if all(isinstance(v, str) for v in given):
+        kind = 'str'
+    elif all(isinstance(v, int) and not isinstance(v, bool) for v in given):
+        kind = 'int'
+    elif all(_is_number(v) for v in given):
+        kind = 'float'
+    else:
+        kind = 'json'
+
+    if kind in ('str', 'json'):
+        keys = [v if kind == 'str' else json.dumps(v, ensure_ascii=False) if v is not None else None
+                for v in values]
+        table = {}
+        codes = np.array([-1 if key is None else table.setdefault(key, len(table)) for key in keys],
+                         dtype=np.int32)
+        blob, offsets = _string_table(list(table))
+        return kind, {'codes': codes, 'blob': blob, 'offsets': offsets}
+
+    dtype = np.int64 if kind == 'int' else np.float64
+    data = np.array([0 if v is None else v for v in values], dtype=dtype)
+    return kind, {'values': data, 'present': present}
+
+
+def write_store(path, network=None, attributes=None):
+    # Имена: сначала ключи JSON (в их порядке), затем соседи, которые сами не ключи.
+    source = network if network is not None else attributes or {}
+    names = list(source)
+    index = {name: i for i, name in enumerate(names)}
+    if network is not None:
+        for links in network.values():
+            for other in links:
+                if other not in index:
+                    index[other] = len(names)
+                    names.append(other)
+
+    header = {'rows': len(source), 'network': network is not None, 'columns': []}
+    sections = {}
+    sections['names_blob'], sections['names_offsets'] = _string_table(names)
+
+    if network is not None:
+        indptr = np.zeros(len(source) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(links) for links in network.values()])
+        indices = np.fromiter((index[o] for links in network.values() for o in links),
+                              dtype=np.int32, count=int(indptr[-1]))
+        raw = [w for links in network.values() for w in links.values()]
+        weights = np.array(raw, dtype=np.float64)
+        is_int = np.array([isinstance(w, int) for w in raw], dtype=np.uint8)
+        header['weights'] = 'int' if is_int.all() and len(raw) else 'float' if not is_int.any() else 'mixed'
+        if header['weights'] == 'mixed':
+            sections['weight_is_int'] = is_int
+        sections['indptr'] = indptr
+        sections['indices'] = indices
+        sections['weights'] = weights.astype(np.float32) if _float32_exact(weights) else weights
+
+    if attributes is not None:
+        keys = list(dict.fromkeys(key for info in attributes.values() for key in info))
+        rows = [attributes.get(name, {}) for name in names[:len(source)]]
+        for i, key in enumerate(keys):
+            kind, arrays = _encode_column([info.get(key) if key in info else None for info in rows])
+            header['columns'].append({'name': key, 'type': kind})
+            for part, array in arrays.items():
+                sections[f'col_{i}_{part}'] = array
+        # None в JSON отличается от отсутствующего ключа: отметка "ключ есть".
+        for i, key in enumerate(keys):
+            sections[f'col_{i}_has'] = np.array([key in info for info in rows], dtype=np.uint8)
+
+    layout = {}
+    offset = 0
+    for name, array in sections.items():
+        array = np.ascontiguousarray(array)
+        sections[name] = array
+        layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header['sections'] = layout
+
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    header_bytes += b' ' * (-(len(MAGIC) + 8 + len(header_bytes)) % ALIGN)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.write(array.tobytes())
+            f.write(b'\0' * (-array.nbytes % ALIGN))
+    os.replace(tmp_path, path)
+
+
+class GraphStore:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path}: неизвестный формат")
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(f.read(header_size).decode('utf-8'))
+        base = len(MAGIC) + 8 + header_size
+        self.arrays = {}
+        for name, info in self.header['sections'].items():
+            shape = tuple(info['shape'])
+            if int(np.prod(shape)) == 0:
+                self.arrays[name] = np.empty(shape, dtype=info['dtype'])
+            else:
+                self.arrays[name] = np.memmap(path, dtype=info['dtype'], mode='r',
+                                              offset=base + info['offset'], shape=shape)
+        self.names = _read_strings(self.arrays['names_blob'], self.arrays['names_offsets'])
+        self.rows = self.header['rows']
+        self.has_network = self.header['network']
+        self.columns = [column['name'] for column in self.header['columns']]
+
+    def square_indptr(self):
+        # indptr для квадратной матрицы n x n: имена-не-ключи - пустые строки.
+        indptr = np.asarray(self.arrays['indptr'])
+        tail = np.full(len(self.names) - self.rows, indptr[-1], dtype=indptr.dtype)
+        return np.concatenate([indptr, tail])
+
+    def weights(self):
+        return _restore_floats(self.arrays['weights'])
+
+    def edges(self):
+        indptr = np.asarray(self.arrays['indptr'])
+        src = np.repeat(np.arange(self.rows), np.diff(indptr))
+        names = self.names
+        return zip([names[i] for i in src.tolist()],
+                   [names[j] for j in self.arrays['indices'].tolist()],
+                   self._weight_values())
+
+    def _weight_values(self):
+        weights = self.weights().tolist()
+        kind = self.header.get('weights')
+        if kind == 'int':
+            return [int(w) for w in weights]
+        if kind == 'mixed':
+            mask = self.arrays['weight_is_int'].tolist()
+            return [int(w) if flag else w for w, flag in zip(weights, mask)]
+        return weights
+
+    def column(self, name):
+        i = self.columns.index(name)
+        kind = self.header['columns'][i]['type']
+        has = self.arrays[f'col_{i}_has'].tolist()
+        if kind in ('str', 'json'):
+            table = _read_strings(self.arrays[f'col_{i}_blob'], self.arrays[f'col_{i}_offsets'])
+            if kind == 'json':
+                table = [json.loads(value) for value in table]
+            values = [table[code] if code >= 0 else None for code in self.arrays[f'col_{i}_codes'].tolist()]
+        else:
+            values = self.arrays[f'col_{i}_values'].tolist()
+            present = self.arrays[f'col_{i}_present'].tolist()
+            values = [v if p else None for v, p in zip(values, present)]
+        return values, has
+
+    def to_network(self):
+        network = {name: {} for name in self.names[:self.rows]}
+        for char, other, weight in self.edges():
+            network[char][other] = weight
+        return network
+
+    def to_attributes(self):
+        attributes = {name: {} for name in self.names[:self.rows]}
+        rows = self.names[:self.rows]
+        for name in self.columns:
+            values, has = self.column(name)
+            for char, value, flag in zip(rows, values, has):
+                if flag:
+                    attributes[char][name] = value
+        return attributes
+
+    def to_json(self):
+        return self.to_network() if self.has_network else self.to_attributes()
+
+
+def open_store(json_path):
+    # Бинарная копия используется, только если она не старше JSON.
+    path = binary_path(json_path)
+    try:
+        if os.path.exists(json_path) and os.path.getmtime(path) < os.path.getmtime(json_path):
+            return None
+        return GraphStore(path)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_data(path, data):
+    if is_network(data):
+        write_store(path, network=data)
+    else:
+        write_store(path, attributes=data)
+
+
+def load_data(json_path):
+    store = open_store(json_path)
+    if store is not None:
+        return store.to_json()
+    with open(json_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Конвертация сети персонажей между JSON и бинарным форматом")
+    parser.add_argument("command", choices=["to-binary", "to-json"], help="Направление конвертации")
+    parser.add_argument("input", help="Входной файл")
+    parser.add_argument("output", nargs='?', help="Выходной файл (по умолчанию рядом со входным)")
+    args = parser.parse_args()
+
+    if args.command == "to-binary":
+        with open(args.input, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        output = args.output or binary_path(args.input)
+        write_data(output, data)
+    else:
+        data = GraphStore(args.input).to_json()
+        output = args.output or os.path.splitext(args.input)[0] + ".json"
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    print(f"Сохранено в {output}")
+
+
+if __name__ == "__main__":
+    main()
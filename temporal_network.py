@@ -0,0 +1,161 @@
+import re
+import json
+import bisect
+import threading
+import numpy as np
+
+# Заголовок главы - короткая строка "Глава" (или "Chapter") с номером: арабским, римским
+# или порядковым словом ("Глава двадцать первая"). Без номера "Глава ..." в прозе - это
+# "руководитель", а не заголовок ("Глава Отдела магического транспорта кивнул.").
+CHAPTER_NUMBER = (r'(?:\d+|(?-i:[IVXLCDM]+)'
+                  r'|(?:(?:двадцать|тридцать|сорок|пятьдесят)[ \t]+)?'
+                  r'(?:перв|втор|трет|четв[её]рт|пят|шест|седьм|восьм|девят|десят|одиннадцат|'
+                  r'двенадцат|тринадцат|четырнадцат|пятнадцат|шестнадцат|семнадцат|восемнадцат|'
+                  r'девятнадцат|двадцат|тридцат|сороков|пятидесят)(?:ая|ья)'
+                  r'|(?:(?:twenty|thirty|forty|fifty)[ \t-]+)?'
+                  r'(?:one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|\w+teen|'
+                  r'twenty|thirty|forty|fifty))')
+CHAPTER_RE = re.compile(r'^[ \t]*(?:глава|chapter)[ \t]+' + CHAPTER_NUMBER + r'(?!\w)[^\n]{0,80}$',
+                        re.IGNORECASE | re.MULTILINE)
+TIMELINE_MODES = ('cumulative', 'sliding')
+
+
+def display_name(name):
+    return ' '.join(word.capitalize() for word in name.split())
+
+
+class ChapterTimeline:
+    # Связи одной книги с номером главы, в которой они возникли. Номера глав идут от начала
+    # книги через все куски (как позиции в MentionLog); глава 0 - текст до первого заголовка.
+    def __init__(self):
+        self.chapter = 0
+        self.titles = [""]
+        self.offsets = []
+        self.doc_titles = []
+        self.chapters, self.rows, self.cols, self.weights = [], [], [], []
+
+    def begin_document(self, text):
+        headings = list(CHAPTER_RE.finditer(text))
+        self.offsets = [m.start() for m in headings]
+        self.doc_titles = [m.group(0).strip() for m in headings]
+
+    def chapter_of(self, start_char):
+        return self.chapter + bisect.bisect_right(self.offsets, start_char)
+
+    def add(self, chapters, rows, cols, weights):
+        self.chapters.extend(chapters)
+        self.rows.extend(rows)
+        self.cols.extend(cols)
+        self.weights.extend(weights)
+
+    def end_document(self):
+        self.chapter += len(self.offsets)
+        self.titles.extend(self.doc_titles)
+        self.offsets, self.doc_titles = [], []
+
+    def deltas(self):
+        # Приращения по главам: пара (i < j) внутри главы встречается один раз с суммой весов.
+        chapters = np.asarray(self.chapters, dtype=np.int64)
+        rows = np.asarray(self.rows, dtype=np.int64)
+        cols = np.asarray(self.cols, dtype=np.int64)
+        low, high = np.minimum(rows, cols), np.maximum(rows, cols)
+        keys, inverse = np.unique(np.stack([chapters, low, high], axis=1), axis=0, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=np.asarray(self.weights, dtype=float),
+                           minlength=len(keys))
+        return keys[:, 0], keys[:, 1], keys[:, 2], sums
+
+    @classmethod
+    def from_deltas(cls, titles, chapters, rows, cols, weights):
+        timeline = cls()
+        timeline.titles = list(titles)
+        timeline.chapter = len(titles) - 1
+        timeline.add(chapters.tolist(), rows.tolist(), cols.tolist(), weights.tolist())
+        return timeline
+
+
+class SeriesTimeline:
+    # Временные сети серии: по ChapterTimeline на книгу, главы книг идут подряд в порядке
+    # book_files. Хранятся только приращения глав; снимки собираются при чтении.
+    def __init__(self, names, mode='cumulative', window=3):
+        self.names = tuple(names)
+        self.mode = mode
+        self.window = window
+        self.books = {}
+        self.lock = threading.Lock()
+
+    def book(self, file_path):
+        timeline = ChapterTimeline()
+        with self.lock:
+            self.books[file_path] = timeline
+        return timeline
+
+    def to_json(self, book_files):
+        chapters = []
+        for file_path in book_files:
+            timeline = self.books.get(file_path)
+            if timeline is None:
+                continue
+            book = re.sub(r'\.txt$', '', file_path.replace('\\', '/').rsplit('/', 1)[-1])
+            chapter_ids, rows, cols, weights = timeline.deltas()
+            bounds = np.searchsorted(chapter_ids, np.arange(len(timeline.titles) + 1))
+            for chapter, title in enumerate(timeline.titles):
+                start, end = bounds[chapter], bounds[chapter + 1]
+                if chapter == 0 and start == end:
+                    continue
+                chapters.append({
+                    'book': book,
+                    'title': title or "Начало",
+                    'rows': rows[start:end].tolist(),
+                    'cols': cols[start:end].tolist(),
+                    'weights': [round(w, 3) for w in weights[start:end].tolist()],
+                })
+        return {
+            'names': [display_name(name) for name in self.names],
+            'mode': self.mode,
+            'window': self.window,
+            'chapters': chapters,
+        }
+
+    def save(self, output_file, book_files):
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(self.to_json(book_files), f, ensure_ascii=False)
+        print(f"Сохранено в {output_file}")
+
+
+def load_timeline(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def chapter_cells(chapter, n):
+    rows = np.asarray(chapter['rows'], dtype=np.int64)
+    cols = np.asarray(chapter['cols'], dtype=np.int64)
+    return rows * n + cols, np.asarray(chapter['weights'], dtype=float)
+
+
+def timeline_snapshots(timeline, mode=None, window=None):
+    # Снимок t: сумма приращений глав 0..t (cumulative) или последних window глав (sliding).
+    # Обновляются только ячейки изменившихся пар, а множество ненулевых пар (отсортированные
+    # плоские индексы) поддерживается по ним же, поэтому кадр стоит O(приращений + пар
+    # в снимке), а не O(n * n).
+    mode = mode or timeline.get('mode', 'cumulative')
+    window = window or timeline.get('window', 3)
+    n = len(timeline['names'])
+    weights = np.zeros(n * n)
+    active = np.empty(0, dtype=np.int64)
+    chapters = timeline['chapters']
+    for t, chapter in enumerate(chapters):
+        touched, values = chapter_cells(chapter, n)
+        np.add.at(weights, touched, values)
+        if mode == 'sliding' and t >= window:
+            old_touched, old_values = chapter_cells(chapters[t - window], n)
+            np.subtract.at(weights, old_touched, old_values)
+            touched = np.concatenate([touched, old_touched])
+        touched = np.unique(touched)
+        if mode == 'sliding':
+            small = np.abs(weights[touched]) < 1e-9
+            weights[touched[small]] = 0.0
+        nonzero = weights[touched] != 0
+        active = np.union1d(np.setdiff1d(active, touched[~nonzero], assume_unique=True), touched[nonzero])
+        rows, cols = np.divmod(active, n)
+        yield chapter, rows, cols, weights[active]